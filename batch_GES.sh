@@ -0,0 +1,23 @@
+#!/bin/bash
+
+jobs=$1 # Path to the JSON list of configs
+cores=$2 # Number of cores to request
+concurrency=${3:-1} # Number of configs to run at the same time
+let processes=$cores-1
+
+jobname_date="$jobs-c$cores-$(date +%Y%m%d).$(date +%H%M)"
+
+echo "Using the batch file at $jobs:"
+cat $jobs
+echo "Requesting $cores cores"
+echo "Full call:"
+cat << _EOF_ > temp.sh
+#!/bin/bash
+python3 ~/data/CrossCompare/run_OSF.py --batch $jobs -p $processes --concurrency $concurrency > ${jobname_date}.log
+_EOF_
+
+cat temp.sh
+qsub -N $jobname_date -q bio,pub64,free* -pe openmp $cores-$cores -m bea temp.sh
+sleep 5
+rm temp.sh
+echo "---Done---"
@@ -0,0 +1,276 @@
+'''
+Benchmarks the OSF search engines on seeded synthetic screens and on the
+sample data, and compares the results against a saved JSON baseline.
+
+Each measurement runs in a fresh process so that its peak RSS is its own.
+'''
+import argparse
+import json
+import os
+import platform
+import resource
+import time
+from datetime import datetime
+from multiprocessing import Pipe, Process, cpu_count
+from sys import exit
+import numpy as np
+import pandas as pd
+from orthogonal_set_finder import (as_result_array, count_combinations,
+                                   load_data, run_singleprocess)
+import n_dim_finder
+import run_OSF
+
+SAMPLE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'sample_data', 'terminal_test.csv')
+
+# name, rows (enzymes), columns (substrates), dimension
+SUITES = {
+    'quick': [
+        ('synthetic-20x12-d2', 20, 12, 2),
+        ('synthetic-16x10-d3', 16, 10, 3),
+        ('sample-d2', None, None, 2),
+    ],
+    'full': [
+        ('synthetic-60x30-d2', 60, 30, 2),
+        ('synthetic-120x50-d2', 120, 50, 2),
+        ('synthetic-30x20-d3', 30, 20, 3),
+        ('synthetic-20x14-d4', 20, 14, 4),
+        ('sample-d2', None, None, 2),
+        ('sample-d3', None, None, 3),
+    ],
+}
+
+# run_singleprocess() keeps every combination in memory, so only time it on
+# searches up to this size.
+SINGLEPROCESS_LIMIT = 2000000
+
+
+def synthetic_matrix(m, n, dimension, seed=0, floor=1000):
+    '''
+    Seeded enzyme x substrate matrix of log-normal background signal with an
+    orthogonal dimension x dimension submatrix planted at random rows and
+    columns. Returns the DataFrame and the planted (rows, columns) positions.
+    '''
+    rng = np.random.default_rng(seed)
+    values = rng.lognormal(mean=13, sigma=1.5, size=(m, n))
+    rows = np.sort(rng.choice(m, dimension, replace=False))
+    cols = np.sort(rng.choice(n, dimension, replace=False))
+    block = rng.uniform(floor, 10 * floor, size=(dimension, dimension))
+    block[np.diag_indices(dimension)] = rng.uniform(1e9, 1e10, dimension)
+    values[np.ix_(rows, cols)] = block
+    full_data = pd.DataFrame(np.maximum(values, floor),
+                             index=np.arange(1, m + 1),
+                             columns=['s{}'.format(i + 1) for i in range(n)])
+    return full_data, (tuple(rows.tolist()), tuple(cols.tolist()))
+
+
+def case_data(case, seed):
+    name, m, n, dimension = case
+    if m is None:
+        return load_data(SAMPLE_DATA), None
+    return synthetic_matrix(m, n, dimension, seed)
+
+
+def _measure(connection, target, args):
+    '''
+    Runs target(*args) in this (fresh) process and sends back its wall time,
+    result summary and peak RSS of this process and of its children.
+    '''
+    start = time.perf_counter()
+    summary = target(*args)
+    seconds = time.perf_counter() - start
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    connection.send({'seconds': seconds,
+                     'summary': summary,
+                     'peak_rss_mb': own * scale / 2 ** 20,
+                     'peak_child_rss_mb': children * scale / 2 ** 20})
+    connection.close()
+
+
+def measure(target, *args):
+    receiver, sender = Pipe(duplex=False)
+    process = Process(target=_measure, args=(sender, target, args))
+    process.start()
+    sender.close()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def _summary(result):
+    result = as_result_array(result)
+    if not len(result):
+        return {'hits': 0, 'best': None}
+    return {'hits': len(result), 'best': [float(result['rms'][0]),
+                                          [result['rows'][0].tolist(),
+                                           result['cols'][0].tolist()]]}
+
+
+def bench_singleprocess(full_data, dimension, length):
+    return _summary(run_singleprocess(full_data, dimension)[:length])
+
+
+def bench_multiprocess(full_data, dimension, processes, length, engine):
+    return _summary(run_OSF.run_multiprocess(
+        full_data, dimension, numProcesses=processes, top_k=length,
+        engine=engine))
+
+
+def bench_networks(full_data, dimension, processes, length):
+    result = n_dim_finder.run_multiprocess(full_data, 2,
+                                           numProcesses=processes)
+    scored = n_dim_finder.network_table(result, full_data, dimension, length)
+    return {'hits': len(scored)}
+
+
+def run_case(case, process_counts, length, seed, repeat):
+    '''
+    Times every engine on one case. Each timing is the best of repeat runs.
+    '''
+    name, m, n, dimension = case
+    full_data, planted = case_data(case, seed)
+    combinations = count_combinations(full_data.shape[0], full_data.shape[1],
+                                      dimension)
+    # The network pipeline only enumerates the 2 x 2 pairs.
+    pairs = count_combinations(full_data.shape[0], full_data.shape[1], 2)
+    print('{}: {}x{} matrix, {} dimensions, {} combinations.'.format(
+        name, full_data.shape[0], full_data.shape[1], dimension,
+        combinations))
+    runs = []
+    if combinations <= SINGLEPROCESS_LIMIT:
+        runs.append(('run_singleprocess', 1, bench_singleprocess,
+                     (full_data, dimension, length)))
+    for engine in ('brute', 'bnb'):
+        for processes in process_counts:
+            runs.append(('run_multiprocess-' + engine, processes,
+                         bench_multiprocess,
+                         (full_data, dimension, processes, length, engine)))
+    if dimension > 2:
+        runs.append(('networks', process_counts[0], bench_networks,
+                     (full_data, dimension, process_counts[0], length)))
+    results = {}
+    for label, processes, target, args in runs:
+        best = min((measure(target, *args) for _ in range(repeat)),
+                   key=lambda x: x['seconds'])
+        best['processes'] = processes
+        best['combinations_per_second'] = (
+            pairs if label == 'networks' else combinations) / best['seconds']
+        if planted is not None and best['summary'].get('best'):
+            best['planted_found'] = tuple(
+                tuple(x) for x in best['summary']['best'][1]) == planted
+        key = '{}-p{}'.format(label, processes)
+        results[key] = best
+        print('  {:<30} {:>9.3f} s {:>14,.0f} combos/s {:>8.1f} MB'.format(
+            key, best['seconds'], best['combinations_per_second'],
+            max(best['peak_rss_mb'], best['peak_child_rss_mb'])))
+    # Scaling efficiency of each engine against its smallest process count.
+    for engine in ('brute', 'bnb'):
+        label = 'run_multiprocess-' + engine
+        base = results['{}-p{}'.format(label, process_counts[0])]
+        for processes in process_counts:
+            run = results['{}-p{}'.format(label, processes)]
+            run['scaling_efficiency'] = (
+                base['seconds'] * process_counts[0] /
+                (run['seconds'] * processes))
+    return {'combinations': combinations, 'runs': results}
+
+
+def compare(current, baseline, tolerance):
+    '''
+    Lists the runs whose throughput dropped, or whose peak memory grew, by
+    more than tolerance (a fraction) against the baseline.
+    '''
+    regressions = []
+    for case, case_result in current['cases'].items():
+        base_case = baseline.get('cases', {}).get(case)
+        if base_case is None:
+            continue
+        for key, run in case_result['runs'].items():
+            base = base_case['runs'].get(key)
+            if base is None:
+                continue
+            speed = run['combinations_per_second'] / \
+                base['combinations_per_second']
+            if speed < 1 - tolerance:
+                regressions.append('{} {}: throughput {:.0%} of baseline'
+                                   .format(case, key, speed))
+            memory = max(run['peak_rss_mb'], run['peak_child_rss_mb'])
+            base_memory = max(base['peak_rss_mb'], base['peak_child_rss_mb'])
+            if memory > base_memory * (1 + tolerance):
+                regressions.append('{} {}: peak RSS {:.1f} MB vs {:.1f} MB'
+                                   .format(case, key, memory, base_memory))
+            if base.get('planted_found') and not run.get('planted_found'):
+                regressions.append('{} {}: planted submatrix no longer the '
+                                   'top hit'.format(case, key))
+    return regressions
+
+
+def main():
+    #################################################################
+    # setup parser for accepting arguments from the bash shell
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for the orthogonal set finder.')
+    parser.add_argument('-s', '--suite',
+                        help='Which set of cases to run. default: quick.',
+                        choices=sorted(SUITES), default='quick')
+    parser.add_argument('-p', '--processes',
+                        help='Comma separated process counts to time. '
+                        'default: 1,2 and all cores.', default=None)
+    parser.add_argument('-l', '--length',
+                        help='Length of the result list. default: 1000.',
+                        default=1000, type=int)
+    parser.add_argument('-r', '--repeat',
+                        help='Runs per measurement; the best is kept. '
+                        'default: 1.', default=1, type=int)
+    parser.add_argument('--seed',
+                        help='Seed for the synthetic matrices. default: 0.',
+                        default=0, type=int)
+    parser.add_argument('-o', '--output',
+                        help='Save the results as a JSON baseline.',
+                        default=None)
+    parser.add_argument('-b', '--baseline',
+                        help='JSON baseline to check for regressions.',
+                        default=None)
+    parser.add_argument('--tolerance',
+                        help='Allowed slowdown or memory growth against the '
+                        'baseline, as a fraction. default: 0.2.',
+                        default=0.2, type=float)
+    args = vars(parser.parse_args())
+    #################################################################
+    if args['processes']:
+        process_counts = [int(p) for p in args['processes'].split(',')]
+    else:
+        process_counts = sorted({1, 2, cpu_count()})
+    current = {'date': datetime.now().isoformat(),
+               'machine': platform.node(),
+               'cpu_count': cpu_count(),
+               'suite': args['suite'],
+               'seed': args['seed'],
+               'length': args['length'],
+               'cases': {}}
+    for case in SUITES[args['suite']]:
+        current['cases'][case[0]] = run_case(
+            case, process_counts, args['length'], args['seed'],
+            args['repeat'])
+    if args['output']:
+        with open(args['output'], 'w') as output:
+            json.dump(current, output, indent=2)
+        print('Results saved to {}'.format(args['output']))
+    if args['baseline']:
+        with open(args['baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(current, baseline, args['tolerance'])
+        if regressions:
+            print('Regressions against {}:'.format(args['baseline']))
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+        print('No regressions against {}.'.format(args['baseline']))
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,70 @@
+'''
+Merges the shard files of a run split with --shard i/N (e.g. as the tasks of
+an array job) into the final result. Requires the orthogonal_set_finder.py
+file.
+'''
+from orthogonal_set_finder import *
+import argparse
+from sys import exit
+import n_dim_finder
+
+
+def main():
+    #################################################################
+    # setup parser for accepting arguments from the bash shell
+    parser = argparse.ArgumentParser(
+        description='Merges the shard files of a sharded OSF or NETWORK run.')
+    parser.add_argument('shards', nargs='+',
+                        help='The OUTPUT.shard-i-of-N.npz files, one per'
+                        ' shard.')
+    parser.add_argument('-i', '--input',
+                        help='The input .csv the shards were run on.',
+                        required=True)
+    parser.add_argument('-o', '--output',
+                        help='Output file name as .csv', required=True)
+    parser.add_argument('--output_format',
+                        help='Output file format for OSF runs. default: as'
+                        ' given to the shards, else from the output file'
+                        ' extension.', choices=OUTPUT_FORMATS, default=None)
+    parser.add_argument('--cache',
+                        help='Use the binary cache of the cleaned input.'
+                        ' default: off', action='store_true')
+    args = parser.parse_args()
+    #################################################################
+    try:
+        meta, result = merge_shards(args.shards)
+    except (CheckpointError, FileNotFoundError) as error:
+        print(error)
+        return 0
+    print('Merged {} shards into the best {} combinations.'.format(
+        len(args.shards), len(result)))
+    full_data = load_data(args.input, floor=meta['floor'], cache=args.cache)
+    search_data = full_data
+    if meta.get('prefilter'):
+        # The shards searched, and hashed, the prefiltered matrix.
+        search_data = prefilter_data(full_data, meta['dimension'],
+                                     meta['threshold'])[0]
+    key = checkpoint_key(search_data.values, meta['dimension'],
+                         meta['threshold'], meta['top_k'], meta['engine'])
+    if key['data'] != meta['data']:
+        print('{} (with a floor of {}) is not the data the shards were run '
+              'on.'.format(args.input, meta['floor']))
+        return 0
+    if meta.get('networks'):
+        result_df = n_dim_finder.network_table(result, full_data,
+                                               meta['networks'],
+                                               meta['top_k'])
+        print("I found {} combinations for {} dimensions.".format(
+            str(len(result_df)), meta['networks']))
+        result_df.to_csv(args.output, index=False)
+    else:
+        print("Top five hits:")
+        print(list(result_tuples(result[:5])))
+        write_OSF(result, full_data, args.output, list_len=meta['top_k'],
+                  file_format=args.output_format or meta.get('output_format'))
+    print('Result saved to {}'.format(args.output))
+    return 1
+
+
+if __name__ == '__main__':
+    exit(main())
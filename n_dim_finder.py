@@ -7,75 +7,121 @@ import argparse
 from datetime import datetime
 import pandas as pd
 from multiprocessing import Pool
-from itertools import repeat, chain, combinations
+from itertools import combinations
+from sys import exit
+from search_monitor import RunMonitor
+from search_planner import plan_search, plan_summary
 
 
-def distill_result_list(full_formatted_list):
+def distill_result_list(full_formatted_list, full_data=None, list_len=1000):
+    '''
+    Turns 2-dimensional hits into (rank, edge) pairs, where an edge is the
+    sorted pair of its (substrate, enzyme) nodes. Takes a format_OSF() table,
+    or a result array together with the full_data it came from, of which the
+    first list_len hits are used.
+    '''
     distilled = []
-    for i, r, o, m, c1, m1, c2, m2 in full_formatted_list.itertuples():
-        distilled.append((r, tuple(sorted([(c1, m1), (c2, m2)]))))
+    if isinstance(full_formatted_list, pd.DataFrame):
+        for i, r, o, m, c1, m1, c2, m2 in full_formatted_list.itertuples():
+            distilled.append((r, tuple(sorted([(c1, m1), (c2, m2)]))))
+        return distilled
+    arrays = format_OSF_arrays(full_formatted_list, full_data, list_len)
+    if arrays is None:
+        return distilled
+    columns = full_data.columns[arrays['pair_cols'].ravel()]
+    rows = full_data.index[arrays['pair_rows'].ravel()]
+    nodes = list(zip(columns, rows))
+    for i, r in enumerate(arrays['rank'].tolist()):
+        distilled.append((r, tuple(sorted(nodes[2 * i:2 * i + 2]))))
     return distilled
 
 
+def index_network(result_list_distilled):
+    '''
+    Indexes the distilled (rank, edge) pairs by node. Returns the list of
+    nodes, the adjacency sets of every node (by position in that list) and a
+    lookup from a (node, node) pair to the position of its edge in
+    result_list_distilled.
+    '''
+    nodes = []
+    node_ids = {}
+    adjacency = []
+    edge_positions = {}
+    for position, (rank, edge) in enumerate(result_list_distilled):
+        ids = []
+        for node in edge:
+            if node not in node_ids:
+                node_ids[node] = len(nodes)
+                nodes.append(node)
+                adjacency.append(set())
+            ids.append(node_ids[node])
+        u, v = ids
+        adjacency[u].add(v)
+        adjacency[v].add(u)
+        edge_positions.setdefault((min(u, v), max(u, v)), position)
+    return nodes, adjacency, edge_positions
+
+
+def find_cliques(adjacency, dim):
+    '''
+    Yields every set of dim nodes that are all connected to each other, as
+    sorted tuples of node positions. Cliques are grown one node at a time
+    from the common neighbours of the nodes chosen so far, taking only
+    larger node positions so that no node is reused and no clique is found
+    twice.
+    '''
+    def extend(clique, candidates):
+        if len(clique) == dim:
+            yield tuple(clique)
+            return
+        if len(candidates) < dim - len(clique):
+            return
+        for v in sorted(candidates):
+            yield from extend(clique + [v], {u for u in candidates
+                                             if u > v and u in adjacency[v]})
+
+    for u in range(len(adjacency)):
+        yield from extend([u], {v for v in adjacency[u] if v > u})
+
+
 def find_n_dim(result_list_distilled, dim):
-    all_combinations = combinations(result_list_distilled, dim)
-    n_combinations = factorial(
-        len(result_list_distilled)) / factorial(
-            len(result_list_distilled) - dim)
-    expected_edges = (dim * (dim - 1)) / 2
-    valid_sets = []
-    print("Searching {} sets.".format(n_combinations))
-    for combination in all_combinations:
-        if sets_are_nodes4(combination, dim, expected_edges):
-            valid_sets.append(combination)
-    return valid_sets
-
-
-def find_n_dim_multiprocess(chunk_of_combinations, dim, expected_edges):
-    result_list = []
-    for combination in chunk_of_combinations:
-        if sets_are_nodes4(combination, dim, expected_edges):
-            result_list.append(combination)
-    return result_list
-
-
-def sets_are_nodes4(combination, expected_nodes, expected_edges):
-    edgeList = []
-    nodeList = []
-    for r, edge in combination:
-        edgeList.append(edge)
-        nodeList.extend(list(edge))
-    result1, result2 = False, False
-    if len(set(edgeList)) == expected_edges:
-        result1 = True
-    if len(set(nodeList)) == expected_nodes:
-        result2 = True
-    return result1 and result2
-
-
-def find_networks(np_result_f, dim=3, numProcesses=2):
-    distilled = distill_result_list(np_result_f)
-    result = run_multiprocess_n_dim(distilled, dim, numProcesses)
-    return result
-
-
-def run_multiprocess(full_data, dimension, numProcesses=2, threshold=1):
+    '''
+    Finds every network of dim (substrate, enzyme) nodes in which each pair
+    of nodes is a 2D hit, through a clique search over the hit graph. Each
+    network is returned as the tuple of its dim * (dim - 1) / 2 (rank, edge)
+    pairs, in the order that combinations() over result_list_distilled would
+    have produced it.
+    '''
+    nodes, adjacency, edge_positions = index_network(result_list_distilled)
+    networks = []
+    for clique in find_cliques(adjacency, dim):
+        networks.append(tuple(sorted(
+            edge_positions[pair] for pair in combinations(clique, 2))))
+    networks.sort()
+    return [tuple(result_list_distilled[position] for position in network)
+            for network in networks]
+
+
+def find_networks(np_result_f, dim=3, numProcesses=2, full_data=None,
+                  list_len=1000):
+    '''
+    Finds the dim-dimensional networks in a format_OSF() result, or in a
+    result array of the given full_data (see distill_result_list()). The
+    search runs in this process; numProcesses is kept for compatibility.
+    '''
+    distilled = distill_result_list(np_result_f, full_data, list_len)
+    return find_n_dim(distilled, dim)
+
+
+def run_multiprocess(full_data, dimension, numProcesses=2, threshold=1,
+                     monitor=None, top_k=None, shard=None):
     '''
     Method to run OSF search in multiple processes simultaneously.
     '''
-    if __name__ == '__main__':
-        # [ lst[i::n] for i in xrange(n) ] Splits up lst into n segments
-        list_of_combinations = [list(every_matrix(
-            dimension, dimension, full_data))[i::numProcesses] for i in range(
-            numProcesses)]
-        identityMat = np.eye(dimension)
-        full_data_np = full_data.values
-        pool = Pool(processes=numProcesses)
-        result_list = pool.starmap(iterate_RMSs, zip(
-            list_of_combinations, repeat(full_data_np.copy()), repeat(
-                identityMat), repeat(threshold)))
-        merged = list(chain.from_iterable(result_list))
-        return sorted(merged, key=lambda x: x[0])
+    with Pool(processes=numProcesses) as pool:
+        return pool_search(pool, full_data.values, dimension,
+                           numProcesses=numProcesses, threshold=threshold,
+                           top_k=top_k, monitor=monitor, shard=shard)
 
 
 def get_network_score(edgelist, original_data):
@@ -107,91 +153,204 @@ def get_network_score(edgelist, original_data):
     return (score, readable_compounds, readable_mutants)
 
 
+def score_networks(resultlist, original_data):
+    '''
+    Batch version of get_network_score(). Labels are mapped to positions
+    through lookup tables built once, and every network of a given size is
+    scored in one batch_RMSs() call. Returns an array of O scores and the
+    lists of substrate and enzyme label sets, in the order of resultlist.
+    '''
+    column_lookup = {label: i for i, label in enumerate(original_data.columns)}
+    index_lookup = {label: i for i, label in enumerate(original_data.index)}
+    full_data_np = original_data.values
+    substrates = []
+    enzymes = []
+    by_shape = {}
+    for position, edgelist in enumerate(resultlist):
+        compounds = []
+        mutants = []
+        for rank, ((c1, m1), (c2, m2)) in edgelist:
+            compounds.extend([c1, c2])
+            mutants.extend([m1, m2])
+        # Build the position sets in the same order as get_network_score()
+        # so the RMSs are identical to the last bit.
+        compound_inds = tuple(set(column_lookup[c] for c in compounds))
+        mutant_inds = tuple(set(index_lookup[m] for m in mutants))
+        substrates.append(set(compounds))
+        enzymes.append(set(mutants))
+        shape = (len(mutant_inds), len(compound_inds))
+        group = by_shape.setdefault(shape, ([], [], []))
+        group[0].append(position)
+        group[1].append(mutant_inds)
+        group[2].append(compound_inds)
+    scores = np.empty(len(resultlist))
+    for (dim, _), (positions, rows, cols) in by_shape.items():
+        rms = batch_RMSs(full_data_np, np.array(rows), np.array(cols),
+                         np.eye(dim))
+        scores[positions] = o_score(rms, (dim, dim))
+    return scores, substrates, enzymes
+
+
 def format_network_result(resultlist, original_data):
-    as_tuples = []
-    for edgelist in resultlist:
-        as_tuples.append(get_network_score(edgelist, original_data))
-    as_tuples_sorted = sorted(as_tuples, key=lambda x: x[0], reverse=True)
-    return pd.DataFrame(as_tuples_sorted, columns=['Score', 'Substrates', 'Enzymes'])
-
-
-def run_multiprocess_n_dim(full_formatted_list, dim, numProcesses=2):
-    '''
-    Method to run search for >2 dimensions
-    in multiple processes simultaneously.
-    '''
-    if __name__ == '__main__':
-        all_combinations = list(combinations(full_formatted_list, dim))
-
-        expected_edges = (dim * (dim - 1)) / 2
-        chunked_list_of_combinations = [
-            all_combinations[i::numProcesses] for i in range(
-                numProcesses)]
-
-        pool = Pool(processes=numProcesses)
-        result_list = pool.starmap(find_n_dim_multiprocess, zip(
-            chunked_list_of_combinations, repeat(dim), repeat(expected_edges)))
-        merged = list(chain.from_iterable(result_list))
-        return merged
-
-
-#################################################################
-# setup parser for accepting arguments from the bash shell
-parser = argparse.ArgumentParser(
-    description='Multi-process(core) orthogonal set finder.')
-parser.add_argument('-i', '--input',
-                    help='Input file name as .csv. Compounds in columns,'
-                    'mutants in rows.', required=True)
-parser.add_argument('-o', '--output',
-                    help='Output file name as .csv', required=True)
-parser.add_argument('-d', '--dimension',
-                    help='Dimension of search. Default: 2.', default=2,
-                    type=int)
-parser.add_argument('-p', '--processes',
-                    help='Number of processes to spawn. Default: 1.',
-                    default=1, type=int)
-parser.add_argument('-l', '--length',
-                    help='Length of result list to print to csv.'
-                    'default: 1000.', default=1000, type=int)
-parser.add_argument('-t', '--threshold',
-                    help='Number below which RMSs should be kept. Setting to a'
-                    'lower number (0.15) reduces memory usage for larger'
-                    'dimension searches. default: 1.', default=1, type=float)
-args = parser.parse_args()
-
-# run the script printing start and end times and the top five hits at the end.
-print('Running a {}x{} matrix NETWORK search on {} with {} process(es).'
-      'Threshold set to {}.'.format(args.dimension, args.dimension, args.input,
-                                    args.processes, args.threshold))
-try:
-    full_data = pd.read_csv(args.input, index_col=0, dtype='float64')
-except:
-    print("Something went wrong with the import of {}."
-          "Please check the file/path.".format(args.input))
-    raise
-starttime = datetime.now()
-# prep the raw data for processing:
-full_data.index = full_data.index.map(int)  # Allows m numbers to
-# format properly.
-clean_raw_data(full_data)  # Set everything below 1E3 to 1E3.
-# Start the algorithm.
-result = run_multiprocess(full_data, 2,
-                          numProcesses=args.processes,
-                          threshold=args.threshold)
-print("I found {} combinations of pairs.".format(str(len(result))))
-endtime = datetime.now()
-print('Total calculation time: {}'.format(str(endtime - starttime)))
-formatted = format_OSF(result, full_data, list_len=args.length)
-
-# Now take the 2-dimensional run and find higher order networks.
-print("Starting {}-dimensional NETWORK search...".format(args.dimension))
-starttime2 = datetime.now()
-result = find_networks(formatted, args.dimension, args.processes)
-endtime2 = datetime.now()
-print("Done! I found {} combinations for {} dimensions.".format(
-    str(len(result)), args.dimension))
-print('Total calculation time: {}'.format(str(endtime2 - starttime2)))
-print('Result saved to {}'.format(args.output))
-result_df = format_network_result(result, full_data)
-pd.DataFrame(result_df).to_csv(args.output, index=False)  # Write out result.
-#################################################################
+    scores, substrates, enzymes = score_networks(resultlist, original_data)
+    # A stable sort keeps ties in their original order, as sorted() did.
+    order = np.argsort(-scores, kind='stable')
+    return pd.DataFrame({'Score': scores[order],
+                         'Substrates': [substrates[i] for i in order],
+                         'Enzymes': [enzymes[i] for i in order]},
+                        columns=['Score', 'Substrates', 'Enzymes'])
+
+
+def network_table(result, full_data, dimension, length=1000,
+                  monitor=None):
+    '''
+    Finds and scores the dimension-dimensional networks among the best length
+    pairs of a 2-dimensional search result.
+    '''
+    with monitor_stage(monitor, 'networks'):
+        networks = find_networks(result, dimension, full_data=full_data,
+                                 list_len=length)
+    with monitor_stage(monitor, 'score'):
+        return format_network_result(networks, full_data)
+
+
+def main():
+    #################################################################
+    # setup parser for accepting arguments from the bash shell
+    parser = argparse.ArgumentParser(
+        description='Multi-process(core) orthogonal set finder.')
+    parser.add_argument('-i', '--input',
+                        help='Input file name as .csv. Compounds in columns,'
+                        'mutants in rows.', required=True)
+    parser.add_argument('-o', '--output',
+                        help='Output file name as .csv', required=True)
+    parser.add_argument('-d', '--dimension',
+                        help='Dimension of search. Default: 2.', default=2,
+                        type=int)
+    parser.add_argument('-p', '--processes',
+                        help='Number of processes to spawn. Default: 1.',
+                        default=1, type=int)
+    parser.add_argument('-l', '--length',
+                        help='Length of result list to print to csv.'
+                        'default: 1000.', default=1000, type=int)
+    parser.add_argument('-t', '--threshold',
+                        help='Number below which RMSs should be kept. Setting to a'
+                        'lower number (0.15) reduces memory usage for larger'
+                        'dimension searches. default: 1.', default=1, type=float)
+    parser.add_argument('--floor',
+                        help='Values below this are raised to it before the'
+                        ' search. default: 1E3.', default=1000, type=float)
+    parser.add_argument('--cache',
+                        help='Keep the cleaned matrix in a binary cache next to'
+                        ' the input so later runs skip parsing and cleaning.'
+                        ' default: off', action='store_true')
+    parser.add_argument('--prefilter',
+                        help='Before the pair search, drop the enzymes and'
+                        ' substrates that provably cannot be part of a pair'
+                        ' below the threshold. The results are unchanged.'
+                        ' default: off', action='store_true')
+    parser.add_argument('--shard',
+                        help='Only run the pair search on shard i of N'
+                        ' (written i/N, counting from 1) and save its results'
+                        ' to OUTPUT.shard-i-of-N.npz. merge_OSF.py then finds'
+                        ' the networks. default: off', type=parse_shard,
+                        default=None)
+    parser.add_argument('--progress_interval',
+                        help='Seconds between progress lines (percent done,'
+                        ' throughput, ETA, memory). 0 only reports at the end'
+                        ' of the search. default: 60.', default=60, type=float)
+    parser.add_argument('--metrics',
+                        help='Also append the progress and stage timings to'
+                        ' this file as JSON lines. default: off', default=None)
+    parser.add_argument('--plan',
+                        help='Only estimate the pair search: count the'
+                        ' combinations, time a sample of them, and print the'
+                        ' predicted time, memory and number of pairs with'
+                        ' recommended settings. default: off',
+                        action='store_true')
+    parser.add_argument('--auto',
+                        help='Make the --plan estimate, then run with the'
+                        ' recommended number of processes, keeping only the'
+                        ' best LENGTH pairs (the ones the networks use) to'
+                        ' bound memory. default: off', action='store_true')
+    args = parser.parse_args()
+    #################################################################
+
+    # run the script printing start and end times and the top five hits at the end.
+    print('Running a {}x{} matrix NETWORK search on {} with {} process(es).'
+          'Threshold set to {}.'.format(args.dimension, args.dimension, args.input,
+                                        args.processes, args.threshold))
+    monitor = RunMonitor(interval=args.progress_interval,
+                         metrics_path=args.metrics)
+    try:
+        full_data = load_data(args.input, floor=args.floor, cache=args.cache,
+                              monitor=monitor)
+    except:
+        print("Something went wrong with the import of {}."
+              "Please check the file/path.".format(args.input))
+        raise
+    search_data = full_data
+    if args.prefilter:
+        with monitor.stage('prefilter'):
+            search_data, positions, report = prefilter_data(full_data, 2,
+                                                            args.threshold)
+        print(prefilter_summary(report))
+    # Only the best LENGTH pairs are used for the networks, so a shard, or an
+    # --auto run that bounds its memory, only needs to keep those; the
+    # networks are the same.
+    top_k = args.length if args.shard or args.auto else None
+    if args.plan or args.auto:
+        with monitor.stage('plan'):
+            plan = plan_search(search_data, 2, processes=args.processes,
+                               threshold=args.threshold, top_k=top_k,
+                               length=args.length)
+        print('\n'.join(plan_summary(plan, buffer_length=False,
+                                     output=False)))
+        if not args.auto:
+            monitor.close()
+            return 1
+        args.processes = plan['recommended_processes']
+        print('Running with {} process(es), keeping the best {} pairs.'
+              .format(args.processes, args.length))
+    starttime = datetime.now()
+    # Start the algorithm.
+    result = run_multiprocess(search_data, 2,
+                              numProcesses=args.processes,
+                              threshold=args.threshold, monitor=monitor,
+                              top_k=top_k, shard=args.shard)
+    if args.prefilter:
+        result = expand_results(result, positions, full_data.shape)
+    print("I found {} combinations of pairs.".format(str(len(result))))
+    endtime = datetime.now()
+    print('Total calculation time: {}'.format(str(endtime - starttime)))
+    if args.shard is not None:
+        partial = shard_path(args.output, args.shard)
+        save_shard(partial, search_data.values, result, 2, args.threshold,
+                   args.length, 'brute', args.shard, floor=args.floor,
+                   prefilter=args.prefilter,
+                   networks=args.dimension)
+        print('Shard {}/{} saved to {}'.format(args.shard[0], args.shard[1],
+                                               partial))
+        monitor.summary()
+        monitor.close()
+        return 1
+
+    # Now take the 2-dimensional run and find higher order networks.
+    print("Starting {}-dimensional NETWORK search...".format(args.dimension))
+    starttime2 = datetime.now()
+    result_df = network_table(result, full_data, args.dimension, args.length,
+                              monitor)
+    endtime2 = datetime.now()
+    print("Done! I found {} combinations for {} dimensions.".format(
+        str(len(result_df)), args.dimension))
+    print('Total calculation time: {}'.format(str(endtime2 - starttime2)))
+    print('Result saved to {}'.format(args.output))
+    with monitor.stage('write'):
+        pd.DataFrame(result_df).to_csv(args.output, index=False)  # Write out result.
+    monitor.summary()
+    monitor.close()
+    return 1
+
+
+if __name__ == '__main__':
+    exit(main())
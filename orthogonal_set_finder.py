@@ -13,20 +13,262 @@ import pandas as pd
 import numpy as np
 from numpy import mean, sqrt, eye
 from numpy.linalg import norm
-from itertools import chain, repeat, combinations, product
+import bisect
+import hashlib
+import heapq
+import json
+import os
+import queue
+import random
+import time
+from collections import Counter
+from contextlib import nullcontext
+from functools import lru_cache
+from math import comb
+from multiprocessing import resource_tracker, shared_memory
+from itertools import chain, repeat, combinations, product, islice
 
 
-def clean_raw_data(pdarray):
+def clean_raw_data(pdarray, floor=1000):
     """
-    Modifies pdarray in place to set any value below 1E3 to 1E3.
+    Modifies pdarray in place to set any value below floor (1E3 by default)
+    to floor. NaNs are left alone.
 
     This step is necessary for screening luciferases, but may not be needed for
     other applications.
     """
-    for flux_value in np.nditer(pdarray, op_flags=['readwrite']):
-        if flux_value < 1000:
-            flux_value[...] = 1000  # using the elipsis will actually set the
-            # value in the array
+    if isinstance(pdarray, pd.DataFrame):
+        pdarray.clip(lower=floor, inplace=True)
+    else:
+        np.maximum(pdarray, floor, out=pdarray)
+
+
+CACHE_VERSION = 1
+
+
+def file_hash(path, block_size=1 << 20):
+    '''
+    SHA-256 hex digest of a file's contents.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_paths(path):
+    '''
+    The cleaned-matrix cache files kept next to an input .csv.
+    '''
+    return path + '.osfcache.npy', path + '.osfcache.json'
+
+
+def _read_cache(path, key):
+    values_path, meta_path = cache_paths(path)
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        if meta['key'] != key:
+            return None
+        values = np.load(values_path, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    return pd.DataFrame(values, index=meta['index'], columns=meta['columns'],
+                        copy=False)
+
+
+def _write_cache(path, key, full_data):
+    values_path, meta_path = cache_paths(path)
+    meta = {'key': key,
+            'index': full_data.index.tolist(),
+            'columns': full_data.columns.tolist()}
+    # Write to temporary files first so a killed run leaves no half cache.
+    with open(values_path + '.tmp', 'wb') as values_file:
+        np.save(values_file, np.ascontiguousarray(full_data.values))
+    with open(meta_path + '.tmp', 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(values_path + '.tmp', values_path)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def monitor_stage(monitor, name):
+    '''
+    Times a stage on a search_monitor.RunMonitor, if there is one.
+    '''
+    return nullcontext() if monitor is None else monitor.stage(name)
+
+
+def load_data(path, floor=1000, cache=False, monitor=None):
+    '''
+    Reads an input .csv, maps the row labels to int and applies
+    clean_raw_data() with the given floor (None to skip it).
+
+    With cache=True the cleaned matrix is saved next to the .csv as a
+    memory-mappable .npy with its labels in a .json, keyed by the file's hash
+    and the floor. Later runs on the same file and floor load that instead of
+    parsing and cleaning the .csv again. The load and clean stages are timed
+    on monitor if one is given.
+    '''
+    with monitor_stage(monitor, 'load'):
+        if cache:
+            key = {'version': CACHE_VERSION, 'sha256': file_hash(path),
+                   'floor': floor}
+            full_data = _read_cache(path, key)
+            if full_data is not None:
+                return full_data
+        full_data = pd.read_csv(path, index_col=0, dtype='float64')
+        full_data.index = full_data.index.map(int)  # Allows m numbers to
+        # format properly.
+    with monitor_stage(monitor, 'clean'):
+        if floor is not None:
+            clean_raw_data(full_data, floor)
+        if cache:
+            _write_cache(path, key, full_data)
+    return full_data
+
+
+def _others_sums(squares, count):
+    '''
+    For every entry of a 2D array, the sums of the count smallest and of the
+    count largest entries in its column, leaving out the entry itself.
+    Needs more than count rows.
+    '''
+    if count == 0:
+        return np.zeros_like(squares), np.zeros_like(squares)
+    ordered = np.sort(squares, axis=0)
+    # An entry among the count smallest (largest) is taken out of the
+    # count + 1 smallest (largest); otherwise the count smallest are used.
+    low = np.where(squares <= ordered[count - 1],
+                   ordered[:count + 1].sum(axis=0) - squares,
+                   ordered[:count].sum(axis=0))
+    high = np.where(squares >= ordered[-count],
+                    ordered[-count - 1:].sum(axis=0) - squares,
+                    ordered[-count:].sum(axis=0))
+    return low, high
+
+
+def selectivity_bounds(values, dimension, max_block=1 << 22):
+    '''
+    Lower bounds on the squared distance from the identity (RMS^2 x d^2) of
+    any dimension x dimension submatrix that uses a given row, and of any
+    that uses a given column, of a non-negative matrix. Returns the (m,) row
+    bounds and the (n,) column bounds.
+
+    With the columns normalized over the chosen rows R, the squared distance
+    equals both ||N N^T - I||^2 and the sum of 2 cos^2 over the column pairs.
+    For a row i in R, the norm of column k over R is at most
+    x_ik^2 + (the d - 1 largest other x_jk^2) and at least x_ik^2 + (the
+    d - 1 smallest), so s_ik = x_ik^2 / (x_ik^2 + largest) and the same
+    with the smallest bound the share of row i in column k. This gives:
+
+    - cos_kl >= sqrt(s_ik s_il) for every row i in R (all terms are >= 0),
+      so the pairs cost at least (sum s)^2 - sum s^2 over the d smallest
+      s_ik of the row.
+    - (N N^T)_ii is the sum of the shares of row i, so it is off from 1 by
+      at least the gap between 1 and the possible range of that sum.
+    - For a column k, cos_kl is at least the d-th smallest sqrt(s_ik s_il)
+      over the rows, for each of the d - 1 other columns.
+    '''
+    d = dimension
+    m, n = values.shape
+    squares = values * values
+    low, high = _others_sums(squares, d - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        least = squares / (squares + high)
+        most = squares / (squares + low)
+    smallest = np.sort(least, axis=1)[:, :d]
+    pairs = smallest.sum(axis=1) ** 2 - (smallest ** 2).sum(axis=1)
+    largest_sum = np.sort(most, axis=1)[:, -d:].sum(axis=1)
+    diagonal = np.where(largest_sum < 1, (1 - largest_sum) ** 2,
+                        np.where(smallest.sum(axis=1) > 1,
+                                 (smallest.sum(axis=1) - 1) ** 2, 0))
+    row_bounds = np.maximum(pairs, diagonal)
+    col_bounds = np.empty(n)
+    root = np.sqrt(least)
+    step = max(1, max_block // max(m * n, 1))
+    for start in range(0, n, step):
+        ks = np.arange(start, min(start + step, n))
+        # (k, i, l) products, then the d-th smallest over the rows i.
+        products = root.T[ks][:, :, None] * root[None, :, :]
+        cos = np.partition(products, d - 1, axis=1)[:, d - 1, :]
+        cos[np.arange(len(ks)), ks] = np.inf
+        costs = np.sort(2 * cos * cos, axis=1)[:, :d - 1]
+        col_bounds[ks] = costs.sum(axis=1)
+    return row_bounds, col_bounds
+
+
+def selectivity_prefilter(values, dimension, threshold):
+    '''
+    Finds the rows and columns of values that can be part of a hit below the
+    threshold, by dropping those whose selectivity_bounds() already exceed
+    it and repeating on what is left (which tightens the bounds) until
+    nothing changes. Returns the positions of the rows and columns to keep.
+    No hit is ever dropped. Matrices with negative or non-finite values are
+    left as they are.
+    '''
+    values = np.asarray(values, dtype='float64')
+    rows = np.arange(values.shape[0])
+    cols = np.arange(values.shape[1])
+    if not np.isfinite(values).all() or (values < 0).any():
+        return rows, cols
+    # Slack so rounding in the bounds can never drop a true hit.
+    limit = (dimension * threshold) ** 2 * (1 + 1e-9) + 1e-12
+    while len(rows) >= dimension and len(cols) >= dimension:
+        row_bounds, col_bounds = selectivity_bounds(
+            values[np.ix_(rows, cols)], dimension)
+        keep_rows = ~(row_bounds > limit)
+        keep_cols = ~(col_bounds > limit)
+        if keep_rows.all() and keep_cols.all():
+            return rows, cols
+        rows, cols = rows[keep_rows], cols[keep_cols]
+    return rows[:0], cols[:0]
+
+
+def prefilter_data(full_data, dimension, threshold):
+    '''
+    Applies selectivity_prefilter() to a DataFrame. Returns the DataFrame of
+    the rows and columns kept, their positions in full_data (for
+    expand_results()) and a dict with the numbers of rows, columns and
+    combinations before and after.
+    '''
+    m, n = full_data.shape
+    rows, cols = selectivity_prefilter(full_data.values, dimension,
+                                       threshold)
+    kept = full_data.iloc[rows, cols]
+    report = {'rows': m, 'rows_kept': len(rows),
+              'columns': n, 'columns_kept': len(cols),
+              'combinations': count_combinations(m, n, dimension),
+              'combinations_kept': count_combinations(len(rows), len(cols),
+                                                      dimension)}
+    report['combinations_pruned'] = (report['combinations'] -
+                                     report['combinations_kept'])
+    return kept, (rows, cols), report
+
+
+def expand_results(results, positions, shape):
+    '''
+    Maps a result array found on the rows and columns kept by
+    prefilter_data() back to the positions of the full matrix of the given
+    shape. The order of the results is unchanged.
+    '''
+    rows, cols = positions
+    dimension = results.dtype['rows'].shape[0]
+    return make_results(results['rms'], rows[results['rows']],
+                        cols[results['cols']],
+                        result_dtype(dimension, index_type(*shape)))
+
+
+def prefilter_summary(report):
+    '''
+    One line describing a prefilter_data() report.
+    '''
+    return ('Selectivity prefilter kept {} of {} enzymes and {} of {} '
+            'substrates, skipping {:,} of {:,} combinations ({:.1%}).'.format(
+                report['rows_kept'], report['rows'], report['columns_kept'],
+                report['columns'], report['combinations_pruned'],
+                report['combinations'], report['combinations_pruned'] /
+                max(report['combinations'], 1)))
 
 
 def every_matrix(m, n, pandasArray):
@@ -96,13 +338,1491 @@ def iterate_RMSs(list_to_process, full_data, identityMat, threshold=1):
     return result_list
 
 
+def gather_submatrices(full_data, rows, cols):
+    '''
+    Takes (B, d) integer arrays of row and column indicies and returns every
+    submatrix of the full data in one (B, d, d) array.
+    '''
+    return full_data[rows[:, :, None], cols[:, None, :]]
+
+
+def batch_RMSs(full_data, rows, cols, identityMat=None):
+    '''
+    Vectorized check_RMSs(). Takes (B, d) arrays of row and column indicies
+    and returns a (B,) array of RMSDs from the identity matrix. Normalization,
+    the Gram matrices and the RMS are each done in a single call for the whole
+    block, and the values are identical to those of check_RMSs().
+    '''
+    if identityMat is None:
+        identityMat = np.eye(rows.shape[1])
+    submatricies = gather_submatrices(full_data, rows, cols)
+    submatricies_normd = submatricies / norm(
+        submatricies, axis=1, keepdims=True)
+    orthog_submatricies = np.matmul(
+        submatricies_normd, submatricies_normd.transpose(0, 2, 1))
+    square_distance = np.power((orthog_submatricies - identityMat), 2)
+    return np.sqrt(np.mean(square_distance, axis=(1, 2)))
+
+
+def batch_RMSs_2d(full_data, rows, cols):
+    '''
+    Closed form of batch_RMSs() for 2x2 submatricies. Avoids building the
+    (B, 2, 2) stack entirely. The BLAS used by check_RMSs() may round the Gram
+    matrix differently, so values can differ from it in the last place.
+    '''
+    a = full_data[rows[:, 0], cols[:, 0]]
+    b = full_data[rows[:, 0], cols[:, 1]]
+    c = full_data[rows[:, 1], cols[:, 0]]
+    d = full_data[rows[:, 1], cols[:, 1]]
+    norm0 = np.sqrt(a * a + c * c)
+    norm1 = np.sqrt(b * b + d * d)
+    a, c = a / norm0, c / norm0
+    b, d = b / norm1, d / norm1
+    diag0 = a * a + b * b - 1
+    diag1 = c * c + d * d - 1
+    off_diag = a * c + b * d
+    return np.sqrt((diag0 * diag0 + 2 * off_diag * off_diag +
+                    diag1 * diag1) / 4)
+
+
+def batch_hits(full_data, rows, cols, threshold=1, identityMat=None):
+    '''
+    Returns the positions in the block with an RMS below the threshold and
+    their RMSs. For 2x2 submatricies the closed form is used to screen the
+    block and only the survivors are recomputed with batch_RMSs(), so the
+    returned values still match check_RMSs() exactly.
+    '''
+    if rows.shape[1] == 2:
+        rms = batch_RMSs_2d(full_data, rows, cols)
+        # A little slack so rounding can never drop a true hit.
+        candidates = np.flatnonzero(rms <= threshold * (1 + 1e-9))
+        rms = batch_RMSs(full_data, rows[candidates], cols[candidates],
+                         identityMat)
+    else:
+        candidates = np.arange(len(rows))
+        rms = batch_RMSs(full_data, rows, cols, identityMat)
+    keep = rms < threshold
+    return candidates[keep], rms[keep]
+
+
+def index_type(m, n):
+    '''
+    Smallest integer type that can hold the row and column positions of an m
+    x n matrix.
+    '''
+    return np.int16 if max(m, n) <= np.iinfo(np.int16).max else np.int32
+
+
+def result_dtype(dimension, positions=np.int16):
+    '''
+    Structured dtype of a search result: the RMS and the row and column
+    positions of the submatrix. About 8 + 4d bytes a hit, where a tuple of
+    tuples takes several hundred.
+    '''
+    return np.dtype([('rms', 'f8'), ('rows', positions, (dimension,)),
+                     ('cols', positions, (dimension,))])
+
+
+def make_results(rms, rows, cols, dtype):
+    '''
+    Packs matching arrays of RMSs and (B, d) row and column positions into a
+    result array. Empty inputs, which need not have the (B, d) shape, give
+    an empty result array.
+    '''
+    results = np.empty(len(rms), dtype=dtype)
+    if not len(results):
+        return results
+    results['rms'] = rms
+    results['rows'] = rows
+    results['cols'] = cols
+    return results
+
+
+def as_result_array(results, dtype=None):
+    '''
+    Returns results as a result array. Lists of (rms, combination) tuples, as
+    returned by run_singleprocess(), are converted.
+    '''
+    if isinstance(results, np.ndarray):
+        return results
+    results = list(results)
+    if dtype is None:
+        dimension = len(results[0][1][0]) if results else 0
+        dtype = result_dtype(dimension, np.int64)
+    return make_results([result[0] for result in results],
+                        [result[1][0] for result in results],
+                        [result[1][1] for result in results], dtype)
+
+
+def sort_results(results):
+    '''
+    Sorts a result array by RMS with ties broken by the rows, then the
+    columns. This is the order sorted() gives the (rms, combination) tuples.
+    '''
+    dimension = results.dtype['rows'].shape[0]
+    keys = [results['cols'][:, i] for i in reversed(range(dimension))]
+    keys += [results['rows'][:, i] for i in reversed(range(dimension))]
+    keys.append(results['rms'])
+    return results[np.lexsort(keys)]
+
+
+def result_tuples(results):
+    '''
+    Yields the results as (rms, ((rows), (cols))) tuples.
+    '''
+    for rms, rows, cols in zip(results['rms'], results['rows'].tolist(),
+                               results['cols'].tolist()):
+        yield rms, (tuple(rows), tuple(cols))
+
+
+class TopK(object):
+    '''
+    The best k results below a threshold, kept as a sorted result array
+    rather than a heap. Ties in RMS are broken by the combination so the
+    kept set is the same as the head of sorted() over every result. With
+    k=None every result below the threshold is kept.
+
+    New results are buffered and merged into the kept array with one sort
+    once there are about k of them. unique=True drops repeated combinations
+    at each merge, for searches that may score a combination more than once.
+    '''
+
+    def __init__(self, k=None, threshold=1, dtype=None, unique=False):
+        self.k = k
+        self.threshold = threshold
+        self.unique = unique
+        self.dtype = dtype or result_dtype(0)
+        self._kept = np.empty(0, dtype=self.dtype)
+        self._pending = []
+        self._n_pending = 0
+
+    def __len__(self):
+        # Buffered results are all below the cutoff and distinct from the
+        # kept ones, so a merge would keep min(all of them, k). Counting them
+        # rather than merging keeps len() cheap for progress reports.
+        if self.unique:
+            self._merge()
+        count = len(self._kept) + self._n_pending
+        return count if self.k is None else min(count, self.k)
+
+    def is_full(self):
+        return self.k is not None and len(self._kept) >= self.k
+
+    def cutoff(self):
+        '''
+        The RMS below which a new result could still be kept. This is the
+        threshold until k results are held, then the current k-th best RMS
+        (nudged up so that a tie can still win on its combination).
+        '''
+        if not self.is_full() or not len(self._kept):
+            return self.threshold
+        return min(self.threshold,
+                   np.nextafter(self._kept['rms'][self.k - 1], np.inf))
+
+    def extend(self, results):
+        '''
+        Adds a result array, e.g. the sorted array returned by a worker.
+        '''
+        results = results[results['rms'] < self.cutoff()]
+        if not len(results):
+            return
+        self._pending.append(results)
+        self._n_pending += len(results)
+        if (self.k is not None or self.unique) and \
+                self._n_pending >= max(self.k or 0, 1024):
+            self._merge()
+
+    def _merge(self):
+        if not self._pending:
+            return
+        merged = sort_results(np.concatenate([self._kept] + self._pending))
+        if self.unique:
+            merged = unique_results(merged)
+        self._kept = merged if self.k is None else merged[:self.k]
+        self._pending = []
+        self._n_pending = 0
+
+    def sorted(self):
+        self._merge()
+        return self._kept
+
+
+def count_combinations(m, n, dimension):
+    '''
+    Number of combinations every_matrix() yields for a matrix with m rows
+    and n columns, i.e. C(m, d) x C(n, d).
+    '''
+    return comb(m, dimension) * comb(n, dimension)
+
+
+@lru_cache(maxsize=None)
+def binomial_table(n, k):
+    '''
+    Table of C(a, b) for a <= n and b <= k as an int64 array.
+    '''
+    table = np.zeros((n + 1, k + 1), dtype=np.int64)
+    for a in range(n + 1):
+        for b in range(min(a, k) + 1):
+            table[a, b] = comb(a, b)
+    return table
+
+
+def unrank_combinations(ranks, n, k):
+    '''
+    Vectorized inverse of the lexicographic numbering used by
+    itertools.combinations(range(n), k). Takes an array of ranks and returns
+    the matching (len(ranks), k) array of combinations.
+    '''
+    binomials = binomial_table(n, k)
+    ranks = np.array(ranks, dtype=np.int64)
+    result = np.empty((len(ranks), k), dtype=np.int64)
+    low = np.zeros(len(ranks), dtype=np.int64)
+    for position in range(k - 1):
+        # starts[c]: number of combinations whose element at this position is
+        # below c, given the elements before it.
+        starts = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(binomials[n - 1 - np.arange(n), k - 1 - position],
+                  out=starts[1:])
+        candidate = np.searchsorted(starts, ranks + starts[low],
+                                    side='right') - 1
+        ranks -= starts[candidate] - starts[low]
+        result[:, position] = candidate
+        low = candidate + 1
+    if k:
+        # Each choice of the last element is a single combination.
+        result[:, k - 1] = low + ranks
+    return result
+
+
+def combination_block(start, count, m, n, dimension):
+    '''
+    Returns the (rows, cols) index arrays for the combinations with ranks
+    start to start + count in every_matrix() order, where the rank of
+    ((r1, r2,...), (c1, c2,...)) is row_rank * C(n, d) + column_rank.
+    '''
+    n_column_combinations = comb(n, dimension)
+    ranks = np.arange(start, start + count, dtype=np.int64)
+    row_ranks, column_ranks = np.divmod(ranks, n_column_combinations)
+    # Only a few distinct row combinations fall in any one block.
+    first_row_rank = row_ranks[0]
+    row_table = unrank_combinations(
+        np.arange(first_row_rank, row_ranks[-1] + 1), m, dimension)
+    rows = row_table[row_ranks - first_row_rank]
+    # The column ranks run on from the first one, wrapping around, so only
+    # min(count, C(n, d)) distinct column combinations are needed.
+    first_column_rank = column_ranks[0]
+    distinct = min(count, n_column_combinations)
+    column_table = unrank_combinations(
+        (first_column_rank + np.arange(distinct)) % n_column_combinations,
+        n, dimension)
+    cols = column_table[(column_ranks - first_column_rank) %
+                        n_column_combinations]
+    return rows, cols
+
+
+def share_data(full_data_np):
+    '''
+    Copies the data matrix into a new block of shared memory. Returns the
+    SharedMemory object, which the caller must close() and unlink(), and a
+    small picklable spec that workers pass to attach_shared_data().
+    '''
+    full_data_np = np.ascontiguousarray(full_data_np, dtype='float64')
+    shm = shared_memory.SharedMemory(create=True,
+                                     size=max(full_data_np.nbytes, 1))
+    shared = np.ndarray(full_data_np.shape, dtype='float64', buffer=shm.buf)
+    shared[...] = full_data_np
+    return shm, (shm.name, full_data_np.shape)
+
+
+_attached_data = {}
+
+
+def _attach_untracked(name):
+    '''
+    Attaches to an existing block of shared memory without registering it
+    with this process's resource tracker, which would otherwise try to
+    clean up (and warn about) a block the parent owns.
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13 has no track argument.
+        pass
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def attach_shared_data(data_spec):
+    '''
+    Returns a read-only view of a matrix published with share_data(). Each
+    process attaches to a given block only once, and closes the blocks of
+    earlier searches when it attaches to a new one, so a long-lived Pool
+    does not keep every matrix it was ever given mapped.
+    '''
+    name, shape = data_spec
+    if name not in _attached_data:
+        detach_shared_data()
+        shm = _attach_untracked(name)
+        full_data = np.ndarray(shape, dtype='float64', buffer=shm.buf)
+        full_data.flags.writeable = False
+        _attached_data[name] = (shm, full_data)
+    return _attached_data[name][1]
+
+
+def detach_shared_data(data_spec=None):
+    '''
+    Closes this process's attachment to the block of data_spec, or to every
+    block if None. The block itself stays until its owner unlinks it.
+    '''
+    names = list(_attached_data) if data_spec is None else [data_spec[0]]
+    for name in names:
+        if name not in _attached_data:
+            continue
+        shm, full_data = _attached_data.pop(name)
+        del full_data
+        try:
+            shm.close()
+        except BufferError:
+            # A view is still in use; the mapping goes with it.
+            pass
+
+
+def search_rank_range(data_spec, dimension, start, count, threshold=1,
+                      top_k=None, batch_size=65536):
+    '''
+    Worker for a (start, count) range of combination ranks. Attaches to the
+    shared data matrix, unranks its own combinations block by block and
+    returns the best top_k results below the threshold as a sorted result
+    array.
+    '''
+    full_data = attach_shared_data(data_spec)
+    m, n = full_data.shape
+    identityMat = np.eye(dimension)
+    dtype = result_dtype(dimension, index_type(m, n))
+    best = TopK(top_k, threshold, dtype)
+    for block_start in range(start, start + count, batch_size):
+        block_count = min(batch_size, start + count - block_start)
+        rows, cols = combination_block(block_start, block_count, m, n,
+                                       dimension)
+        positions, rms = batch_hits(full_data, rows, cols, best.cutoff(),
+                                    identityMat)
+        best.extend(make_results(rms, rows[positions], cols[positions],
+                                 dtype))
+
+    return best.sorted()
+
+
+def column_cosines(full_data, row_sets):
+    '''
+    For a (B, d) array of row sets, returns the (B, n, n) cosines between
+    every pair of data columns restricted to each set of rows.
+    '''
+    submatricies = full_data[row_sets]
+    unit_columns = submatricies / norm(submatricies, axis=1, keepdims=True)
+    return np.matmul(unit_columns.transpose(0, 2, 1), unit_columns)
+
+
+def _grow_columns(full_data, row_sets, pair_costs, owner, cols, sse,
+                  dimension, best, identityMat, max_frontier):
+    '''
+    Depth-first part of bnb_rank_range(). Extends every partial column set in
+    the frontier by one larger column, adds the new pair costs and drops any
+    branch whose partial SSE already exceeds the current cutoff.
+    '''
+    n = pair_costs.shape[1]
+    level = cols.shape[1]
+    if level == dimension:
+        rows = row_sets[owner]
+        positions, rms = batch_hits(full_data, rows, cols, best.cutoff(),
+                                    identityMat)
+        best.extend(make_results(rms, rows[positions], cols[positions],
+                                 best.dtype))
+        return
+    # Leave room for the columns still to be chosen.
+    n_children = np.maximum(n - (dimension - level) - cols[:, -1], 0)
+    ends = np.cumsum(n_children)
+    piece_start = 0
+    while piece_start < len(cols):
+        # Expand the frontier in pieces so it never exceeds max_frontier.
+        offset = ends[piece_start - 1] if piece_start else 0
+        piece_end = max(piece_start + 1, int(np.searchsorted(
+            ends, offset + max_frontier, side='right')))
+        children = n_children[piece_start:piece_end]
+        parent = np.repeat(np.arange(piece_start, piece_end), children)
+        first_child = np.repeat(np.cumsum(children) - children, children)
+        new_col = (cols[parent, -1] + 1 +
+                   np.arange(len(parent)) - first_child)
+        new_sse = sse[parent] + pair_costs[
+            owner[parent][:, None], cols[parent], new_col[:, None]].sum(axis=1)
+        # Slack so rounding in the partial sums can never prune a true hit.
+        cutoff = best.cutoff()
+        keep = new_sse <= (dimension * cutoff) ** 2 * (1 + 1e-9) + 1e-12
+        parent = parent[keep]
+        _grow_columns(full_data, row_sets, pair_costs, owner[parent],
+                      np.column_stack((cols[parent], new_col[keep])),
+                      new_sse[keep], dimension, best, identityMat,
+                      max_frontier)
+        piece_start = piece_end
+
+
+def bnb_rank_range(data_spec, dimension, start, count, threshold=1,
+                   top_k=None, max_frontier=1 << 20):
+    '''
+    Exact branch-and-bound worker for a (start, count) range of row
+    combination ranks, returning the same sorted result array as
+    search_rank_range() would over those rows and every column combination.
+
+    The Gram matrix of the column-normalized submatrix, N N^T, has the same
+    distance from the identity as N^T N, whose diagonal is exactly 1 and
+    whose off-diagonal entries are the cosines between pairs of columns over
+    the chosen rows. So with the rows fixed, the squared RMS x d^2 is a sum of
+    2 cos^2 over the chosen column pairs, and the sum over a partial column
+    set is a lower bound for every completion of it. Column sets are grown
+    one column at a time and cut as soon as that bound passes the cutoff;
+    survivors are scored with batch_hits() so the values match check_RMSs().
+    '''
+    full_data = attach_shared_data(data_spec)
+    m, n = full_data.shape
+    identityMat = np.eye(dimension)
+    best = TopK(top_k, threshold, result_dtype(dimension, index_type(m, n)))
+    if n < dimension:
+        return best.sorted()
+    block_size = max(1, max_frontier // (n * n))
+    for block_start in range(start, start + count, block_size):
+        block_count = min(block_size, start + count - block_start)
+        row_sets = unrank_combinations(
+            np.arange(block_start, block_start + block_count), m, dimension)
+        cosines = column_cosines(full_data, row_sets)
+        pair_costs = 2 * cosines * cosines
+        first_cols = np.arange(n - dimension + 1)
+        owner = np.repeat(np.arange(block_count), len(first_cols))
+        cols = np.tile(first_cols, block_count)[:, None]
+        _grow_columns(full_data, row_sets, pair_costs, owner, cols,
+                      np.zeros(len(owner)), dimension, best, identityMat,
+                      max_frontier)
+
+    return best.sorted()
+
+
+SEARCH_ENGINES = {
+    # name: (worker, size of its rank space for an m x n matrix)
+    'brute': (search_rank_range, count_combinations),
+    'bnb': (bnb_rank_range, lambda m, n, dimension: comb(m, dimension)),
+}
+
+
+def _search_task(task):
+    '''
+    Pool wrapper around the engine workers. Also returns the
+    worker's pid, the first rank and number of ranks in the task and the
+    seconds it took for the scheduler's bookkeeping.
+    '''
+    worker = SEARCH_ENGINES[task[0]][0]
+    start = time.perf_counter()
+    worker_best = worker(*task[1:])
+    return (os.getpid(), task[3], task[4], worker_best,
+            time.perf_counter() - start)
+
+
+def default_task_size(total, numProcesses, engine='brute'):
+    '''
+    Aims for many small tasks (~64 per process) so that uneven costs even out,
+    without making them so small that dispatch dominates. A bnb task is a
+    range of row sets, each of which covers every column combination.
+    '''
+    if engine == 'bnb':
+        return int(min(4096, max(1, total // (64 * max(numProcesses, 1)))))
+    return int(min(65536, max(1024, total // (64 * max(numProcesses, 1)))))
+
+
+CHECKPOINT_VERSION = 2
+
+
+class CheckpointError(ValueError):
+    '''
+    Raised when a checkpoint does not belong to the search being resumed.
+    '''
+
+
+def data_hash(full_data_np):
+    '''
+    SHA-256 hex digest of a matrix's values as float64, to tell whether saved
+    results were found in the same data.
+    '''
+    return hashlib.sha256(np.ascontiguousarray(full_data_np,
+                                               dtype='float64').data
+                          ).hexdigest()
+
+
+def checkpoint_key(full_data_np, dimension, threshold, top_k, engine,
+                   shard=None):
+    '''
+    Everything a checkpoint must match to be resumed: the data (by hash) and
+    the search settings that change which results are kept.
+    '''
+    return {'version': CHECKPOINT_VERSION, 'data': data_hash(full_data_np),
+            'shape': list(full_data_np.shape), 'dimension': dimension,
+            'threshold': float(threshold), 'top_k': top_k, 'engine': engine,
+            'shard': list(shard) if shard else None}
+
+
+def parse_shard(text):
+    '''
+    Parses an 'i/N' shard specification (1 <= i <= N, as numbered by array
+    jobs) into the tuple (i, N).
+    '''
+    index, count = (int(x) for x in text.split('/'))
+    if not 1 <= index <= count:
+        raise ValueError('Shard {} is not between 1 and {}.'.format(
+            index, count))
+    return index, count
+
+
+def shard_range(total, shard):
+    '''
+    The [start, end) ranks of range(total) that shard (i, N) covers. The
+    shards are contiguous, in order and differ in size by at most one rank.
+    '''
+    index, count = shard
+    return total * (index - 1) // count, total * index // count
+
+
+def shard_path(path, shard):
+    '''
+    Name of the partial result file of one shard of a run writing to path.
+    '''
+    return '{}.shard-{}-of-{}.npz'.format(path, *shard)
+
+
+def merge_ranges(ranges):
+    '''
+    Merges [start, end) rank ranges into the fewest sorted ranges.
+    '''
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def add_range(ranges, start, end):
+    '''
+    Adds [start, end) to a list of merged, sorted rank ranges in place,
+    joining it with the ranges it touches, so that the list stays as short
+    as merge_ranges() would make it.
+    '''
+    i = bisect.bisect_left(ranges, [start])
+    if i and ranges[i - 1][1] >= start:
+        i -= 1
+    j = i
+    while j < len(ranges) and ranges[j][0] <= end:
+        j += 1
+    if i < j:
+        start = min(start, ranges[i][0])
+        end = max(end, ranges[j - 1][1])
+    ranges[i:j] = [[start, end]]
+
+
+def remaining_ranges(done, end, start=0):
+    '''
+    Yields the [start, end) ranges of range(start, end) not covered by the
+    merged ranges in done.
+    '''
+    for done_start, done_end in done:
+        if done_start > start:
+            yield start, min(done_start, end)
+        start = max(start, done_end)
+        if start >= end:
+            return
+    if start < end:
+        yield start, end
+
+
+def save_checkpoint(path, key, done, results):
+    '''
+    Saves the completed rank ranges and the results kept so far to a single
+    .npz file. It is written to a temporary file and moved into place, so a
+    run killed mid-write leaves the previous checkpoint intact.
+    '''
+    meta = dict(key, done=merge_ranges(done))
+    with open(path + '.tmp', 'wb') as checkpoint_file:
+        np.savez(checkpoint_file, meta=np.array(json.dumps(meta)),
+                 results=results)
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(path, key):
+    '''
+    Reads a checkpoint written by save_checkpoint(). Returns the completed
+    rank ranges and the kept results as a result array, or None if there is
+    no checkpoint at path. Raises CheckpointError if it was made for other
+    data or settings.
+    '''
+    try:
+        meta, results = read_results(path)
+    except FileNotFoundError:
+        return None
+    done = meta.pop('done')
+    if meta != key:
+        raise CheckpointError('The checkpoint {} was made for a different '
+                              'search ({} changed).'.format(
+                                  path, ', '.join(_changed(meta, key))))
+    return done, results
+
+
+def _changed(meta, key):
+    return sorted(name for name in set(meta) | set(key)
+                  if meta.get(name) != key.get(name))
+
+
+def save_shard(path, full_data_np, results, dimension, threshold, top_k,
+               engine, shard, **extra):
+    '''
+    Saves the results of a finished shard for merge_shards(). Any extra
+    settings needed to finish the run after the merge are stored with them.
+    '''
+    m, n = full_data_np.shape
+    total = SEARCH_ENGINES[engine][1](m, n, dimension)
+    key = dict(checkpoint_key(full_data_np, dimension, threshold, top_k,
+                              engine, shard), **extra)
+    save_checkpoint(path, key, [list(shard_range(total, shard))], results)
+
+
+def read_results(path):
+    '''
+    Reads the metadata of a checkpoint or shard file and returns it with its
+    sorted result array.
+    '''
+    with np.load(path, allow_pickle=False) as saved:
+        return json.loads(str(saved['meta'])), saved['results']
+
+
+def merge_shards(paths):
+    '''
+    Merges the partial result files of a sharded run (one per shard, written
+    by save_checkpoint() once the shard finished) with a streaming k-way
+    merge. Returns the shared metadata and the top_k results, which are the
+    same as those of a single run over every shard. Raises CheckpointError if
+    the files are from different searches, or shards are missing or
+    unfinished.
+    '''
+    if not paths:
+        raise CheckpointError('No shard files to merge.')
+    metas, arrays = zip(*(read_results(path) for path in paths))
+    first = dict(metas[0], shard=None, done=None)
+    shards = set()
+    m, n = first['shape']
+    total = SEARCH_ENGINES[first['engine']][1](m, n, first['dimension'])
+    for path, meta in zip(paths, metas):
+        if meta['shard'] is None:
+            raise CheckpointError('{} is not a shard file.'.format(path))
+        other = dict(meta, shard=None, done=None)
+        if other != first:
+            raise CheckpointError(
+                '{} is from a different search than {} ({} changed).'.format(
+                    path, paths[0], ', '.join(_changed(other, first))))
+        shard = tuple(meta['shard'])
+        if shard in shards:
+            raise CheckpointError('Shard {}/{} is given twice.'.format(*shard))
+        shards.add(shard)
+        start, end = shard_range(total, shard)
+        if list(remaining_ranges(merge_ranges(meta['done']), end, start)):
+            raise CheckpointError('Shard {}/{} in {} did not finish.'.format(
+                shard[0], shard[1], path))
+    count = metas[0]['shard'][1]
+    missing = sorted(set((i, count) for i in range(1, count + 1)) - shards)
+    if missing or len(shards) != count:
+        raise CheckpointError('Shards missing: {}.'.format(', '.join(
+            '{}/{}'.format(*shard) for shard in missing) or
+            'files have different shard counts'))
+    merged = heapq.merge(*(result_tuples(results) for results in arrays))
+    if first['top_k'] is not None:
+        merged = islice(merged, first['top_k'])
+    del first['shard'], first['done']
+    return first, as_result_array(merged, arrays[0].dtype)
+
+
+def pool_search(pool, full_data_np, dimension, numProcesses=2, threshold=1,
+                top_k=None, buffer_length=1000000, task_size=None,
+                stats=None, engine='brute', monitor=None, checkpoint=None,
+                checkpoint_interval=600, resume=False, shard=None,
+                data_spec=None):
+    '''
+    Runs a full OSF search on an existing Pool. The data is published once in
+    shared memory and every task is a (start_rank, count) range that the
+    worker enumerates itself, so the combinations are never built in the
+    parent.
+
+    Tasks of task_size combinations are handed to the pool with apply_async()
+    and reduced as they finish, so there is no barrier between chunks. At most
+    buffer_length combinations (and never fewer than two tasks per process)
+    are in flight at once; each new task carries the current top-k cutoff
+    and is only submitted when an earlier one returns. Nothing waits inside
+    the pool's own task handler, so searches run from several threads share
+    one Pool side by side.
+    If a dict is passed as stats, the number of tasks and combinations each
+    worker completed is recorded in it.
+
+    engine='bnb' uses the exact branch-and-bound search of bnb_rank_range(),
+    whose tasks are ranges of row combinations rather than of combinations.
+
+    Progress, per-worker throughput and the search and sort stages are
+    reported to monitor (a search_monitor.RunMonitor) if one is given.
+
+    If checkpoint is a path, the completed rank ranges and the results kept
+    so far are saved there every checkpoint_interval seconds, when the search
+    is interrupted and when it ends. With resume=True the search continues
+    from that checkpoint, if it exists, and gives the same results as an
+    uninterrupted run.
+
+    shard=(i, N) only searches the i-th of N contiguous slices of the rank
+    space (see shard_range()), so that a search can be split across nodes and
+    the results combined with merge_shards().
+
+    If the data is already in shared memory (see share_data()), pass its
+    data_spec so that it is not copied again; it is then left in place.
+    '''
+    m, n = full_data_np.shape
+    total = SEARCH_ENGINES[engine][1](m, n, dimension)
+    first, last = shard_range(total, shard) if shard else (0, total)
+    if task_size is None:
+        task_size = default_task_size(last - first, numProcesses, engine)
+    # Number of combinations each rank of the engine's space stands for.
+    per_rank = count_combinations(m, n, dimension) // max(total, 1)
+    in_flight = max(2 * numProcesses,
+                    buffer_length // (task_size * max(per_rank, 1)))
+    arrived = queue.Queue()
+    best = TopK(top_k, threshold, result_dtype(dimension, index_type(m, n)))
+    tasks_per_worker = Counter()
+    combinations_per_worker = Counter()
+    done = []
+    if checkpoint is not None:
+        key = checkpoint_key(full_data_np, dimension, threshold, top_k, engine,
+                             shard)
+        saved = load_checkpoint(checkpoint, key) if resume else None
+        if saved is not None:
+            done, results = saved
+            best.extend(results)
+    resumed = sum(end - start for start, end in done)
+    last_save = time.monotonic()
+    shm = None
+    if data_spec is None:
+        shm, data_spec = share_data(full_data_np)
+
+    ranges = ((start, min(task_size, gap_end - start))
+              for gap_start, gap_end in remaining_ranges(done, last, first)
+              for start in range(gap_start, gap_end, task_size))
+
+    def submit():
+        '''
+        Hands the next range to the pool. Returns False once there are none.
+        '''
+        task = next(ranges, None)
+        if task is None:
+            return False
+        pool.apply_async(_search_task, ((engine, data_spec, dimension) + task +
+                                        (best.cutoff(), top_k),),
+                         callback=arrived.put, error_callback=arrived.put)
+        return True
+
+    if monitor is not None:
+        monitor.begin_search((last - first) * per_rank, numProcesses,
+                             completed=resumed * per_rank)
+    # The finished ranges (with those done before a resume) are only kept
+    # for checkpoints, merged as they arrive.
+    completed = merge_ranges(done)
+    finished = False
+    try:
+        with monitor_stage(monitor, 'search'):
+            pending = sum(submit() for _ in range(in_flight))
+            while pending:
+                outcome = arrived.get()
+                if isinstance(outcome, BaseException):
+                    raise outcome
+                pid, start, count, worker_best, seconds = outcome
+                best.extend(worker_best)
+                pending += submit() - 1
+                if checkpoint is not None:
+                    add_range(completed, start, start + count)
+                    finished = True
+                tasks_per_worker[pid] += 1
+                combinations_per_worker[pid] += count * per_rank
+                if monitor is not None:
+                    monitor.task_done(pid, count * per_rank, seconds,
+                                      len(best), best.cutoff())
+                if checkpoint is not None and \
+                        time.monotonic() - last_save >= checkpoint_interval:
+                    save_checkpoint(checkpoint, key, completed, best.sorted())
+                    last_save = time.monotonic()
+    except BaseException:
+        # Keep what was finished before the interruption.
+        if finished:
+            save_checkpoint(checkpoint, key, completed, best.sorted())
+        raise
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+    if stats is not None:
+        stats['tasks_per_worker'] = dict(tasks_per_worker)
+        stats['combinations_per_worker'] = dict(combinations_per_worker)
+    if finished:
+        save_checkpoint(checkpoint, key, completed, best.sorted())
+    if monitor is not None:
+        monitor.end_search()
+    with monitor_stage(monitor, 'sort'):
+        return best.sorted()
+
+
+def cell_scores(full_data):
+    '''
+    How strongly each entry dominates both its row and its column: the
+    product of its share of the column's and of the row's sum of squares.
+    Entries of an orthogonal submatrix's diagonal score highly.
+    '''
+    squares = full_data * full_data
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (squares / squares.sum(axis=0) *
+                  squares / squares.sum(axis=1, keepdims=True))
+    return np.where(np.isnan(scores), -np.inf, scores)
+
+
+def top_cells(full_data, count):
+    '''
+    Row and column positions of the count highest cell_scores().
+    '''
+    scores = cell_scores(full_data)
+    flat = np.argsort(-scores, axis=None, kind='stable')[:count]
+    return np.unravel_index(flat, scores.shape)
+
+
+def _best_states(full_data, rows, cols, width):
+    '''
+    Sorts the (B, s) candidate row and column sets, drops duplicates and
+    returns the width best by RMS with their RMSs.
+    '''
+    rows, cols = np.sort(rows, axis=1), np.sort(cols, axis=1)
+    _, unique = np.unique(np.hstack((rows, cols)), axis=0, return_index=True)
+    rows, cols = rows[unique], cols[unique]
+    rms = batch_RMSs(full_data, rows, cols)
+    order = np.argsort(np.where(np.isnan(rms), np.inf, rms),
+                       kind='stable')[:width]
+    return rows[order], cols[order], rms[order]
+
+
+def beam_seeds(full_data, cells, width):
+    '''
+    The width best 2 x 2 submatrices whose diagonals are two of the given
+    (rows, cols) cells.
+    '''
+    cell_rows, cell_cols = cells
+    i, j = np.triu_indices(len(cell_rows), 1)
+    ok = (cell_rows[i] != cell_rows[j]) & (cell_cols[i] != cell_cols[j])
+    i, j = i[ok], j[ok]
+    return _best_states(full_data,
+                        np.column_stack((cell_rows[i], cell_rows[j])),
+                        np.column_stack((cell_cols[i], cell_cols[j])),
+                        width)
+
+
+def grow_beam(full_data, rows, cols, cells, width):
+    '''
+    Adds one row and one column to every state of the beam, taking them from
+    the (rows, cols) cells that do not clash with the state, and keeps the
+    width best of the grown states.
+    '''
+    cell_rows, cell_cols = cells
+    clash = ((rows[:, :, None] == cell_rows[None, None, :]).any(axis=1) |
+             (cols[:, :, None] == cell_cols[None, None, :]).any(axis=1))
+    state, cell = np.nonzero(~clash)
+    return _best_states(full_data,
+                        np.column_stack((rows[state], cell_rows[cell])),
+                        np.column_stack((cols[state], cell_cols[cell])),
+                        width)
+
+
+def _swaps(chosen, size):
+    '''
+    Every set made by replacing one entry of the sorted set chosen with a
+    position in range(size) not already in it, as a sorted (B, d) array.
+    '''
+    others = np.setdiff1d(np.arange(size), chosen)
+    swapped = np.repeat(chosen[None, :], len(chosen) * len(others), axis=0)
+    slot = np.repeat(np.arange(len(chosen)), len(others))
+    swapped[np.arange(len(swapped)), slot] = np.tile(others, len(chosen))
+    return np.sort(swapped, axis=1)
+
+
+class _BeamState(object):
+    '''
+    State of one beam_worker() call: the data and the results kept. A
+    combination may be scored many times while climbing, so the kept results
+    drop repeats when they are merged.
+    '''
+
+    def __init__(self, full_data, dimension, threshold, top_k):
+        self.full_data = full_data
+        m, n = full_data.shape
+        self.dtype = result_dtype(dimension, index_type(m, n))
+        self.best = TopK(top_k, threshold, self.dtype, unique=True)
+        self.evaluations = 0
+
+    def score(self, rows, cols):
+        '''
+        RMSs of sorted (B, d) row and column sets, which are offered to the
+        kept results.
+        '''
+        rms = batch_RMSs(self.full_data, rows, cols)
+        self.evaluations += len(rms)
+        self.best.extend(make_results(rms, rows, cols, self.dtype))
+        return np.where(np.isnan(rms), np.inf, rms)
+
+    def climb(self, rows, cols, rms, deadline):
+        '''
+        Hill climbing: moves to the best set that differs by one row or one
+        column until none is better or time runs out.
+        '''
+        m, n = self.full_data.shape
+        while time.time() < deadline:
+            row_sets = _swaps(rows, m)
+            col_sets = _swaps(cols, n)
+            candidates_rows = np.vstack((
+                row_sets, np.repeat(rows[None, :], len(col_sets), axis=0)))
+            candidates_cols = np.vstack((
+                np.repeat(cols[None, :], len(row_sets), axis=0), col_sets))
+            if not len(candidates_rows):
+                break
+            scores = self.score(candidates_rows, candidates_cols)
+            move = int(np.argmin(scores))
+            if not scores[move] < rms:
+                break
+            rows, cols = candidates_rows[move], candidates_cols[move]
+            rms = scores[move]
+        return rows, cols, rms
+
+
+def _kick(chosen, size, rng):
+    '''
+    Replaces about half of the sorted set chosen with random other
+    positions in range(size).
+    '''
+    others = np.setdiff1d(np.arange(size), chosen)
+    kick = min(max(1, len(chosen) // 2), len(others))
+    chosen = chosen.copy()
+    chosen[rng.choice(len(chosen), kick, replace=False)] = rng.choice(
+        others, kick, replace=False)
+    return np.sort(chosen)
+
+
+def beam_worker(data_spec, dimension, seed_rows, seed_cols, cells,
+                threshold=1, top_k=None, width=16, deadline=None,
+                restarts=None, seed=0):
+    '''
+    Approximate worker. Grows the given 2 x 2 seeds into a beam of width
+    dimension x dimension sets with the (rows, cols) cells, hill-climbs from
+    each of them, then keeps restarting from randomly perturbed kept results
+    until the deadline (a time.time()) or the number of restarts is reached.
+    Every combination scored is offered to a TopK, and the kept results are
+    returned with the number of scores and restarts made.
+    '''
+    full_data = attach_shared_data(data_spec)
+    m, n = full_data.shape
+    worker = _BeamState(full_data, dimension, threshold, top_k)
+    if deadline is None:
+        deadline = np.inf
+    rows, cols = seed_rows, seed_cols
+    for _ in range(2, dimension):
+        if not len(rows):
+            break
+        rows, cols, rms = grow_beam(full_data, rows, cols, cells, width)
+    starts = [(r, c, worker.score(r[None, :], c[None, :])[0])
+              for r, c in zip(rows, cols)]
+    for r, c, value in starts:
+        if time.time() >= deadline:
+            break
+        worker.climb(r, c, value, deadline)
+    rng = np.random.default_rng(seed)
+    done = 0
+    while starts and time.time() < deadline and (restarts is None or
+                                                 done < restarts):
+        # Kick a kept result (or a start) by replacing about half of its
+        # rows and columns at random, then climb again.
+        kept = worker.best.sorted()
+        if len(kept) and rng.random() < 0.5:
+            pick = kept[rng.integers(min(len(kept), width))]
+            r, c = pick['rows'].astype(np.int64), pick['cols'].astype(np.int64)
+        else:
+            r, c, _ = starts[rng.integers(len(starts))]
+        r, c = _kick(r, m, rng), _kick(c, n, rng)
+        worker.climb(r, c, worker.score(r[None, :], c[None, :])[0], deadline)
+        done += 1
+    return worker.best.sorted(), worker.evaluations, done
+
+
+# Engines whose results may miss some of the best combinations.
+APPROXIMATE_ENGINES = ('beam',)
+
+
+def _beam_task(task):
+    return (os.getpid(),) + beam_worker(*task)
+
+
+def unique_results(results):
+    '''
+    Drops repeated combinations from a sorted result array.
+    '''
+    if len(results) < 2:
+        return results
+    same = ((results['rows'][1:] == results['rows'][:-1]).all(axis=1) &
+            (results['cols'][1:] == results['cols'][:-1]).all(axis=1))
+    return results[np.concatenate(([True], ~same))]
+
+
+def beam_search(pool, full_data_np, dimension, numProcesses=2, threshold=1,
+                top_k=None, width=16, time_budget=60, restarts=None, seed=0,
+                stats=None, data_spec=None):
+    '''
+    Approximate search for large dimensions. The best 2 x 2 submatrices built
+    from the highest cell_scores() are split between numProcesses workers
+    (beam_worker()), which grow them a row and a column at a time, keep
+    the width best at each size, then improve them by swapping single rows
+    and columns and restarting from perturbed results. Each worker stops
+    after time_budget seconds or restarts restarts (at least one must be
+    given). Returns the best top_k distinct combinations scored, as a sorted
+    result array whose RMSs are exact; the best possible ones may be missed.
+    Scores and restarts per worker are recorded in stats if given. As in
+    pool_search(), data_spec reuses data that is already shared.
+    '''
+    if time_budget is None and restarts is None:
+        raise ValueError('beam_search() needs a time_budget or restarts.')
+    m, n = full_data_np.shape
+    dtype = result_dtype(dimension, index_type(m, n))
+    if m < dimension or n < dimension:
+        return np.empty(0, dtype=dtype)
+    deadline = None if time_budget is None else time.time() + time_budget
+    cells = top_cells(full_data_np, max(64, 8 * width))
+    seed_rows, seed_cols, _ = beam_seeds(full_data_np, cells,
+                                         width * numProcesses)
+    shm = None
+    if data_spec is None:
+        shm, data_spec = share_data(full_data_np)
+    tasks = [(data_spec, dimension, seed_rows[w::numProcesses],
+              seed_cols[w::numProcesses], cells, threshold, top_k, width,
+              deadline, restarts, seed + w) for w in range(numProcesses)]
+    best = TopK(None, threshold, dtype)
+    try:
+        evaluations, restarts_done = {}, {}
+        for pid, worker_best, count, done in pool.imap_unordered(
+                _beam_task, tasks):
+            best.extend(worker_best)
+            evaluations[pid] = evaluations.get(pid, 0) + count
+            restarts_done[pid] = restarts_done.get(pid, 0) + done
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+    if stats is not None:
+        stats['evaluations_per_worker'] = evaluations
+        stats['restarts_per_worker'] = restarts_done
+    results = unique_results(best.sorted())
+    return results if top_k is None else results[:top_k]
+
+
+def compare_results(found, exact):
+    '''
+    How an approximate result array compares with the exhaustive one for the
+    same settings. Returns a dict with the share of the exhaustive results
+    that were found (recall), whether the best one was, both best RMSs, the
+    rank the approximate best has in the exhaustive list and both lengths.
+    '''
+    def keys(results):
+        return [tuple(row) for row in np.hstack(
+            (results['rows'], results['cols'])).astype(np.int64).tolist()]
+
+    exact_keys = keys(exact)
+    found_keys = set(keys(found))
+    hits = [key in found_keys for key in exact_keys]
+    ranks = {key: i + 1 for i, key in enumerate(exact_keys)}
+    return {'found': len(found),
+            'exhaustive': len(exact),
+            'recall': sum(hits) / len(exact) if len(exact) else 1.0,
+            'best_found': bool(hits and hits[0]),
+            'found_best_rms': float(found['rms'][0]) if len(found) else None,
+            'exhaustive_best_rms': (float(exact['rms'][0]) if len(exact)
+                                    else None),
+            'found_best_rank': (ranks.get(keys(found[:1])[0])
+                                if len(found) else None)}
+
+
+def matrix_changes(previous, full_data):
+    '''
+    Compares a matrix with an earlier version of it, matching rows and
+    columns by label. Returns boolean arrays over the rows and columns of
+    full_data that are True for the labels that are new. A row with a value
+    that changed in one of the shared columns also counts as new, which
+    covers every combination holding that value.
+    '''
+    old_rows = previous.index.get_indexer(full_data.index)
+    old_cols = previous.columns.get_indexer(full_data.columns)
+    new_rows, new_cols = old_rows < 0, old_cols < 0
+    shared = previous.values[np.ix_(old_rows[~new_rows], old_cols[~new_cols])]
+    current = full_data.values[np.ix_(~new_rows, ~new_cols)]
+    same = (shared == current) | (np.isnan(shared) & np.isnan(current))
+    new_rows[np.flatnonzero(~new_rows)[~same.all(axis=1)]] = True
+    return new_rows, new_cols
+
+
+def delta_rank_range(data_spec, dimension, row_order, col_order, start, count,
+                     full_rows, touching_cols, threshold=1, top_k=None,
+                     batch_size=65536):
+    '''
+    Worker for incremental_search(). The rows and columns are numbered in
+    row_order and col_order, which put the new ones first, so the row sets
+    with ranks below full_rows are the ones holding a new row and the first
+    touching_cols column sets are the ones holding a new column. For the
+    (start, count) range of row set ranks, every column set is scored with
+    the first kind and only the touching ones with the rest. Combinations are
+    mapped back to sorted positions of the matrix before they are scored, so
+    the results match search_rank_range(). Returns the sorted result array
+    and the number of combinations scored.
+    '''
+    full_data = attach_shared_data(data_spec)
+    m, n = full_data.shape
+    identityMat = np.eye(dimension)
+    dtype = result_dtype(dimension, index_type(m, n))
+    best = TopK(top_k, threshold, dtype)
+    column_combinations = comb(n, dimension)
+
+    def column_sets(start, stop):
+        return np.sort(col_order[unrank_combinations(
+            np.arange(start, stop), n, dimension)], axis=1)
+
+    # The first batch of column sets is used by every row set.
+    head = column_sets(0, min(batch_size, column_combinations))
+    row_sets = np.sort(row_order[unrank_combinations(
+        np.arange(start, start + count), m, dimension)], axis=1)
+    ranks = np.arange(start, start + count)
+    scored = 0
+    for row_set_rows, col_count in ((row_sets[ranks < full_rows],
+                                     column_combinations),
+                                    (row_sets[ranks >= full_rows],
+                                     touching_cols)):
+        if not len(row_set_rows) or not col_count:
+            continue
+        per_block = max(1, batch_size // col_count)
+        for block_start in range(0, len(row_set_rows), per_block):
+            block_rows = row_set_rows[block_start:block_start + per_block]
+            for col_start in range(0, col_count, batch_size):
+                col_stop = min(col_start + batch_size, col_count)
+                block_cols = (head[:col_stop] if col_start == 0 else
+                              column_sets(col_start, col_stop))
+                rows = np.repeat(block_rows, len(block_cols), axis=0)
+                cols = np.tile(block_cols, (len(block_rows), 1))
+                positions, rms = batch_hits(full_data, rows, cols,
+                                            best.cutoff(), identityMat)
+                best.extend(make_results(rms, rows[positions],
+                                         cols[positions], dtype))
+                scored += len(rows)
+
+    return best.sorted(), scored
+
+
+def _delta_task(task):
+    start = time.perf_counter()
+    worker_best, scored = delta_rank_range(*task)
+    return (os.getpid(), worker_best, scored, time.perf_counter() - start)
+
+
+def incremental_search(pool, full_data, previous, dimension, numProcesses=2,
+                       threshold=1, top_k=None, engine='brute', task_size=None,
+                       stats=None, monitor=None):
+    '''
+    Updates the results of an earlier search (previous, as returned by
+    result_store.load_results()) for a grown or edited version of the
+    matrix. Only the combinations that use a row or column that is new or
+    changed (see matrix_changes()) are searched, with delta_rank_range(), and
+    merged with the earlier results that use neither. Returns the same sorted result
+    array as pool_search() over full_data.
+
+    The earlier results are only known down to their top_k-th RMS. If
+    dropping those that use changed or removed rows or columns could let in
+    combinations below it that were never kept, or the earlier search had a
+    different dimension, a lower threshold or a shorter list, a full
+    pool_search() with engine is run instead. stats, if given, records the
+    combinations scored, the new or changed rows and columns and whether a
+    full search was needed.
+    '''
+    meta, old_data, old_results = previous
+    m, n = full_data.shape
+    full_data_np = full_data.values
+    dtype = result_dtype(dimension, index_type(m, n))
+    if stats is None:
+        stats = {}
+
+    def full_search(reason):
+        stats.update(full=reason, scored=count_combinations(m, n, dimension))
+        return pool_search(pool, full_data_np, dimension, numProcesses,
+                           threshold, top_k, task_size=task_size,
+                           engine=engine, monitor=monitor)
+
+    if meta['dimension'] != dimension:
+        return full_search('the dimension changed')
+    if meta['threshold'] < threshold or (meta['top_k'] is not None and (
+            top_k is None or top_k > meta['top_k'])):
+        return full_search('the earlier threshold or list length was lower')
+    if meta['engine'] not in SEARCH_ENGINES:
+        return full_search('the earlier search was approximate')
+    if not (full_data.index.is_unique and full_data.columns.is_unique and
+            old_data.index.is_unique and old_data.columns.is_unique):
+        return full_search('the labels are not unique')
+    new_rows, new_cols = matrix_changes(old_data, full_data)
+    stats.update(full=None, new_rows=int(new_rows.sum()),
+                 new_cols=int(new_cols.sum()))
+    # Earlier results that only use unchanged rows and columns still hold.
+    row_map = full_data.index.get_indexer(old_data.index)
+    row_map[row_map >= 0] = np.where(new_rows[row_map[row_map >= 0]], -1,
+                                     row_map[row_map >= 0])
+    col_map = full_data.columns.get_indexer(old_data.columns)
+    col_map[col_map >= 0] = np.where(new_cols[col_map[col_map >= 0]], -1,
+                                     col_map[col_map >= 0])
+    rows = row_map[old_results['rows']]
+    cols = col_map[old_results['cols']]
+    valid = (rows >= 0).all(axis=1) & (cols >= 0).all(axis=1)
+    rows, cols = np.sort(rows[valid], axis=1), np.sort(cols[valid], axis=1)
+    best = TopK(top_k, threshold, dtype)
+    # Rescored so that they match a full search bit for bit.
+    best.extend(make_results(batch_RMSs(full_data_np, rows, cols), rows, cols,
+                             dtype))
+    row_order = np.concatenate((np.flatnonzero(new_rows),
+                                np.flatnonzero(~new_rows)))
+    col_order = np.concatenate((np.flatnonzero(new_cols),
+                                np.flatnonzero(~new_cols)))
+    full_rows = comb(m, dimension) - comb(m - new_rows.sum(), dimension)
+    touching_cols = comb(n, dimension) - comb(n - new_cols.sum(), dimension)
+    total = comb(m, dimension) if touching_cols else full_rows
+    if task_size is None:
+        task_size = default_task_size(total, numProcesses, 'bnb')
+    shm, data_spec = share_data(full_data_np)
+
+    def task_generator():
+        for start in range(0, total, task_size):
+            yield (data_spec, dimension, row_order, col_order, start,
+                   min(task_size, total - start), full_rows, touching_cols,
+                   best.cutoff(), top_k)
+
+    delta = (full_rows * comb(n, dimension) +
+             (comb(m, dimension) - full_rows) * touching_cols)
+    if monitor is not None:
+        monitor.begin_search(delta, numProcesses, label='incremental')
+    try:
+        with monitor_stage(monitor, 'search'):
+            for pid, worker_best, scored, seconds in pool.imap_unordered(
+                    _delta_task, task_generator()):
+                best.extend(worker_best)
+                if monitor is not None:
+                    monitor.task_done(pid, scored, seconds, len(best),
+                                      best.cutoff())
+    finally:
+        shm.close()
+        shm.unlink()
+    if monitor is not None:
+        monitor.end_search()
+    stats['scored'] = delta
+    results = best.sorted()
+    dropped = not valid.all()
+    if dropped and meta['top_k'] is not None and \
+            len(old_results) >= meta['top_k'] and \
+            (top_k is None or len(results) < top_k or
+             results['rms'][-1] >= old_results['rms'][-1]):
+        return full_search('changed rows or columns held earlier results')
+    return results
+
+
+def random_subsets(m, fraction, count, seed=None):
+    '''
+    Draws count random subsets of int(fraction * m) of the m row positions,
+    as subsample.py's random_df_sample() does, from a random.Random(seed).
+    Returns them as sorted position arrays.
+    '''
+    rng = random.Random(seed)
+    return [np.sort(np.array(rng.sample(range(m), int(fraction * m)),
+                             dtype=np.int64)) for _ in range(count)]
+
+
+def ensemble_rank_range(data_spec, dimension, union, membership, start, count,
+                        cutoffs, threshold=1, top_k=None, batch_size=65536):
+    '''
+    Worker for ensemble_search(). Covers a (start, count) range of the row
+    combinations of union (the rows drawn in any subsample), skipping the
+    ones that no subsample holds. membership[i, j] is True if union[i] is in
+    subsample j. Every remaining row set is scored once against every column
+    combination, and each hit is handed to every subsample that holds its
+    rows. Returns a sorted result array per subsample, each with the best
+    top_k results below that subsample's cutoff, and the number of
+    combinations scored.
+    '''
+    full_data = attach_shared_data(data_spec)
+    m, n = full_data.shape
+    identityMat = np.eye(dimension)
+    dtype = result_dtype(dimension, index_type(m, n))
+    best = [TopK(top_k, cutoff, dtype) for cutoff in cutoffs]
+    row_sets = unrank_combinations(np.arange(start, start + count),
+                                   len(union), dimension)
+    holders = membership[row_sets].all(axis=1)
+    keep = holders.any(axis=1)
+    row_sets, holders = union[row_sets[keep]], holders[keep]
+    column_combinations = comb(n, dimension)
+    # The first batch of column sets is used by every row set.
+    head = unrank_combinations(
+        np.arange(min(batch_size, column_combinations)), n, dimension)
+    per_block = max(1, batch_size // max(column_combinations, 1))
+    for block_start in range(0, len(row_sets), per_block):
+        block_rows = row_sets[block_start:block_start + per_block]
+        block_holders = holders[block_start:block_start + per_block]
+        for col_start in range(0, column_combinations, batch_size):
+            col_stop = min(col_start + batch_size, column_combinations)
+            block_cols = (head if col_start == 0 else unrank_combinations(
+                np.arange(col_start, col_stop), n, dimension))
+            owner = np.repeat(np.arange(len(block_rows)), len(block_cols))
+            rows = block_rows[owner]
+            cols = np.tile(block_cols, (len(block_rows), 1))
+            # Keep anything that one of the subsamples involved could use.
+            cutoff = max(best[j].cutoff()
+                         for j in np.flatnonzero(block_holders.any(axis=0)))
+            positions, rms = batch_hits(full_data, rows, cols, cutoff,
+                                        identityMat)
+            hits = make_results(rms, rows[positions], cols[positions], dtype)
+            hit_holders = block_holders[owner[positions]]
+            for j in np.flatnonzero(hit_holders.any(axis=0)):
+                best[j].extend(hits[hit_holders[:, j]])
+
+    return [b.sorted() for b in best], len(row_sets) * column_combinations
+
+
+def _ensemble_task(task):
+    start = time.perf_counter()
+    worker_best, scored = ensemble_rank_range(*task)
+    return (os.getpid(), task[4], task[5], worker_best, scored,
+            time.perf_counter() - start)
+
+
+def ensemble_search(pool, full_data_np, dimension, subsets, numProcesses=2,
+                    threshold=1, top_k=None, task_size=None, monitor=None,
+                    stats=None):
+    '''
+    Runs a full OSF search on each of several row subsets of the data (e.g.
+    from random_subsets()) in one go on an existing Pool. Returns a list with
+    the sorted result array of each subset, with row positions in the full
+    matrix.
+
+    The RMS of a combination does not depend on the rest of the subsample,
+    so rather than searching each subset in turn, the row combinations of
+    all of them are walked once and a combination that several subsets share
+    is only scored once (see ensemble_rank_range()). The tasks are ranges of
+    row combinations of the rows in any subset, streamed through
+    imap_unordered() with each subset's current top-k cutoff. The combinations
+    scored and those a search per subset would have scored are recorded in
+    stats if given, and progress is reported to monitor.
+    '''
+    m, n = full_data_np.shape
+    dtype = result_dtype(dimension, index_type(m, n))
+    union = np.unique(np.concatenate(
+        [np.asarray(subset, dtype=np.int64) for subset in subsets] +
+        [np.empty(0, dtype=np.int64)]))
+    membership = np.zeros((len(union), len(subsets)), dtype=bool)
+    for j, subset in enumerate(subsets):
+        membership[np.searchsorted(union, subset), j] = True
+    total = comb(len(union), dimension)
+    if task_size is None:
+        task_size = default_task_size(total, numProcesses, 'bnb')
+    column_combinations = comb(n, dimension)
+    best = [TopK(top_k, threshold, dtype) for _ in subsets]
+    shm, data_spec = share_data(full_data_np)
+
+    def task_generator():
+        for start in range(0, total, task_size):
+            yield (data_spec, dimension, union, membership, start,
+                   min(task_size, total - start),
+                   [b.cutoff() for b in best], threshold, top_k)
+
+    if monitor is not None:
+        monitor.begin_search(total * column_combinations, numProcesses,
+                             label='ensemble')
+    scored = 0
+    try:
+        with monitor_stage(monitor, 'search'):
+            for pid, start, count, worker_best, task_scored, seconds in \
+                    pool.imap_unordered(_ensemble_task, task_generator()):
+                for j, results in enumerate(worker_best):
+                    best[j].extend(results)
+                scored += task_scored
+                if monitor is not None:
+                    monitor.task_done(pid, count * column_combinations,
+                                      seconds, sum(len(b) for b in best))
+    finally:
+        shm.close()
+        shm.unlink()
+    if stats is not None:
+        stats['scored'] = scored
+        stats['separate'] = sum(comb(len(subset), dimension)
+                                for subset in subsets) * column_combinations
+    if monitor is not None:
+        monitor.end_search()
+    with monitor_stage(monitor, 'sort'):
+        return [b.sorted() for b in best]
+
+
+def aggregate_results(result_arrays):
+    '''
+    Combines the sorted result arrays of several searches of the same data
+    (e.g. from ensemble_search()). Returns the distinct combinations as a
+    result array, most frequent first and then by RMS, and a dict of arrays
+    in the same order: the number of searches that found each one
+    ('frequency') and its best and mean rank in them ('best rank',
+    'mean rank').
+    '''
+    dtype = result_arrays[0].dtype
+    results = np.concatenate(result_arrays)
+    ranks = np.concatenate([np.arange(1, len(r) + 1) for r in result_arrays])
+    keys = np.hstack((results['rows'], results['cols']))
+    _, first, inverse = np.unique(keys, axis=0, return_index=True,
+                                  return_inverse=True)
+    inverse = inverse.ravel()
+    frequency = np.bincount(inverse)
+    best_rank = np.full(len(first), np.iinfo(np.int64).max)
+    np.minimum.at(best_rank, inverse, ranks)
+    mean_rank = np.bincount(inverse, weights=ranks) / frequency
+    combined = results[first].astype(dtype)
+    dimension = dtype['rows'].shape[0]
+    order = [combined['cols'][:, i] for i in reversed(range(dimension))]
+    order += [combined['rows'][:, i] for i in reversed(range(dimension))]
+    order = np.lexsort(order + [combined['rms'], -frequency])
+    return combined[order], {'frequency': frequency[order],
+                             'best rank': best_rank[order],
+                             'mean rank': mean_rank[order]}
+
+
+@lru_cache(maxsize=None)
+def worst_RMS(shape):
+    '''
+    RMSD from the identity of a matrix of ones, the worst possible result for
+    a given shape. Cached, as o_score() is called once per hit.
+    '''
+    worst = np.ones(shape)
+    return RMS_identity(worst, np.eye(shape[0]))
+
+
 def o_score(rms, shape=(2, 2)):
     '''
     Convert an RMSD score to a more human-readable orthogonality score.
+    Works on a single RMS or an array of them.
     '''
-    worst = np.ones(shape)
-    worst_RMS = RMS_identity(worst, np.eye(shape[0]))
-    return 2 * (worst_RMS / rms)
+    return 2 * (worst_RMS(tuple(shape)) / rms)
 
 
 def run_singleprocess(full_data, dimension):
@@ -116,66 +1836,307 @@ def run_singleprocess(full_data, dimension):
     return sorted(result_list, key=lambda x: x[0])
 
 
-def format_OSF(sorted_result_list_np, full_data, list_len=1000):
+def _label_sort_keys(labels):
     '''
-    Takes a result list from run_singleprocess() or run_multiprocess() and
-    formats a DataFrame for export with DataFrame.to_csv().
+    Returns the position of each label in sorted(labels), so index arrays can
+    be put in label order with an argsort.
     '''
-    # First, get the numpy back into pandas-readable stuff
-    sorted_result_list = []
-    compounds = full_data.index
-    mutants = full_data.columns
-    for rms, cm_tup in sorted_result_list_np:
-        c = (compounds[pos] for pos in cm_tup[0])
-        m = (mutants[pos] for pos in cm_tup[1])
-        sorted_result_list.append((rms, (c, m)))
+    order = sorted(range(len(labels)), key=lambda i: labels[i])
+    keys = np.empty(len(labels), dtype=np.int64)
+    keys[order] = np.arange(len(labels))
+    return keys
+
+
+def format_OSF_arrays(sorted_result_list_np, full_data, list_len=1000):
+    '''
+    Vectorized core of format_OSF(). For the first list_len results, returns
+    a dict of arrays: the 'rank' and 'O score' of each hit, the 'rows' and
+    'cols' of its submatrix (positions, each put in label order), the
+    submatrix 'values' and the (c, m) pair assignment as 'pair_cols' and
+    'pair_rows' positions. Returns None if there are no results.
+    '''
+    results = as_result_array(sorted_result_list_np[:list_len])
+    if len(results) == 0:
+        return None
+    rms = results['rms']
+    rows = results['rows'].astype(np.int64)
+    cols = results['cols'].astype(np.int64)
+    dimension = rows.shape[1]
+    # Submatrices are shown with their labels sorted, as .loc[sorted()] did.
+    row_keys = _label_sort_keys(list(full_data.index))
+    col_keys = _label_sort_keys(list(full_data.columns))
+    rows = np.take_along_axis(rows, np.argsort(row_keys[rows], axis=1), axis=1)
+    cols = np.take_along_axis(cols, np.argsort(col_keys[cols], axis=1), axis=1)
+    values = gather_submatrices(full_data.values, rows, cols)
+    # The row holding each column's maximum (first one on ties, NaNs skipped
+    # like idxmax()) is the intended partner of that column.
+    best_rows = np.argmax(np.where(np.isnan(values), -np.inf, values), axis=1)
+    pair_rows = np.take_along_axis(rows, best_rows, axis=1)
+    duplicate = (np.diff(np.sort(best_rows, axis=1), axis=1) == 0).any(axis=1)
+    if set(full_data.index) & set(full_data.columns):
+        # A row label could also clash with a column label.
+        for i in np.flatnonzero(~duplicate):
+            labels = list(full_data.columns[cols[i]]) + list(
+                full_data.index[pair_rows[i]])
+            duplicate[i] = len(labels) != len(set(labels))
+    # If the assignment is ambiguous, pair the rows and columns in order.
+    pair_rows[duplicate] = rows[duplicate]
+    return {
+        'rank': np.arange(1, len(results) + 1),
+        'O score': o_score(rms, (dimension, dimension)),
+        'rows': rows,
+        'cols': cols,
+        'values': values,
+        'pair_cols': cols,
+        'pair_rows': pair_rows,
+    }
+
+
+def pair_labels(dimension):
+    '''
+    Column names of the (c, m) pair assignment: c1, m1, c2, m2, ...
+    '''
+    return ['{}{}'.format(cm, p) for p in range(1, dimension + 1)
+            for cm in ('c', 'm')]
+
+
+def _pairs(arrays, full_data, i):
+    pairs = []
+    for c, m in zip(arrays['pair_cols'][i], arrays['pair_rows'][i]):
+        pairs.append(full_data.columns[c])
+        pairs.append(full_data.index[m])
+    return pairs
+
 
+def format_OSF(sorted_result_list_np, full_data, list_len=1000):
+    '''
+    Takes the results of run_singleprocess() (a list of tuples) or
+    run_multiprocess() (a result array) and formats a DataFrame for export
+    with DataFrame.to_csv().
+    '''
     pd.set_option('display.float_format', '{:.2E}'.format)  # Forces pandas
     # to use sci-notation.
+    arrays = format_OSF_arrays(sorted_result_list_np, full_data, list_len)
+    if arrays is None:
+        return pd.DataFrame([], columns=['rank', 'O score', 'matrix'])
+    dimension = arrays['rows'].shape[1]
     working_list = []
-    # With an RMS threshold it is possible that the desired result list length
-    # is larger than the result list itself.
-    if list_len > len(sorted_result_list):
-        list_range = range(len(sorted_result_list))
-    else:
-        list_range = range(list_len)
-    for i in list_range:
-        subdf = full_data.loc[
-            sorted(list(sorted_result_list[i][1][0])),  # Get mutants.
-            sorted(list(sorted_result_list[i][1][1]))  # Get compounds.
-        ]
-        pairs = []
-        # This is supposed to search for the intended pairs, but it may not
-        # work right when the RMS is so bad that the appropriate pair does
-        # not exist.
-        for column in subdf.columns:
-            row = subdf[column].idxmax()
-            pairs.append(column)
-            pairs.append(row)
-        # If pairs contains duiplicate rows:
-        # Then just assign pairs and compounds the default order.
-        if len(pairs) != len(set(pairs)):
-            pairs = []
-            c = 0
-            while c < len(subdf.columns):
-                pairs.append(subdf.columns[c])
-                pairs.append(subdf.index[c])
-                c += 1
-
-        working_list.append([
-            i + 1,
-            o_score(sorted_result_list[i][0], subdf.shape),
-            subdf
-        ] + pairs)
-    pairwise_label = ['1', '1', '2', '2', '3', '3', '4', '4', '5', '5']
-    # should look into actually generating this.
-    cm_label = ['c', 'm'] * subdf.shape[0]
-    fd_labels = ["{}{}".format(cm, p) for cm, p in zip(
-        cm_label, pairwise_label)]
+    for i in range(len(arrays['rank'])):
+        subdf = pd.DataFrame(arrays['values'][i],
+                             index=full_data.index[arrays['rows'][i]],
+                             columns=full_data.columns[arrays['cols'][i]])
+        working_list.append([arrays['rank'][i], arrays['O score'][i], subdf] +
+                            _pairs(arrays, full_data, i))
     columns = [
         'rank',
         'O score',
         'matrix'
-    ] + fd_labels
+    ] + pair_labels(dimension)
     resultDF = pd.DataFrame(working_list, columns=columns)
     return resultDF
+
+
+def format_ensemble(results, counts, full_data, searches, list_len=1000):
+    '''
+    Formats the output of aggregate_results() over searches searches as a
+    DataFrame: the format_OSF() columns, with the matrix rendered as text,
+    plus how many searches found each submatrix ('frequency', and as a
+    'fraction' of them) and its best and mean rank in them.
+    '''
+    table = pd.concat(list(iter_OSF_chunks(results, full_data, list_len)),
+                      ignore_index=True)
+    length = len(table)
+    for position, column in enumerate(['frequency', 'fraction', 'best rank',
+                                       'mean rank']):
+        if column == 'fraction':
+            values = counts['frequency'][:length] / searches
+        else:
+            values = counts[column][:length]
+        table.insert(2 + position, column, values)
+    return table
+
+
+def _render_matrix(values, row_labels, col_labels):
+    '''
+    Renders a submatrix as str(DataFrame) does under the '{:.2E}' display
+    format set by format_OSF(), without building the DataFrame.
+    '''
+    index = [str(label) for label in row_labels]
+    index_width = max(len(label) for label in index)
+    columns = []
+    for j, label in enumerate(col_labels):
+        cells = ['NaN' if np.isnan(value) else '{:.2E}'.format(value)
+                 for value in values[:, j]]
+        # pandas pads the header of a numeric column with one space.
+        cells.insert(0, ' ' + str(label))
+        width = max(len(cell) for cell in cells)
+        columns.append([cell.rjust(width) for cell in cells])
+    lines = [''.ljust(index_width)] + [label.ljust(index_width)
+                                       for label in index]
+    for column in columns:
+        lines = [line + ' ' + cell for line, cell in zip(lines, column)]
+    return '\n'.join(lines)
+
+
+def _matrix_texts(arrays, full_data, start, stop):
+    '''
+    The 'matrix' text of results start to stop. Uses _render_matrix() when it
+    reproduces pandas on the first result and the matrices are plain, and
+    str(DataFrame) otherwise.
+    '''
+    def pandas_text(i):
+        return str(pd.DataFrame(arrays['values'][i],
+                                index=full_data.index[arrays['rows'][i]],
+                                columns=full_data.columns[arrays['cols'][i]]))
+
+    def fast_text(i):
+        return _render_matrix(arrays['values'][i],
+                              full_data.index[arrays['rows'][i]],
+                              full_data.columns[arrays['cols'][i]])
+
+    values = arrays['values'][start:stop]
+    plain = (full_data.index.name is None and
+             full_data.columns.name is None and
+             not np.isinf(values).any())
+    texts = []
+    for i in range(start, stop):
+        text = fast_text(i) if plain else pandas_text(i)
+        if plain and (i == 0 or len(text.split('\n', 1)[0]) >
+                      pd.get_option('display.width')):
+            # Check against pandas, which wraps wide frames.
+            plain = text == pandas_text(i)
+            text = pandas_text(i)
+        texts.append(text)
+    return texts
+
+
+def iter_OSF_chunks(sorted_result_list_np, full_data, list_len=1000,
+                    chunk_size=1000, flat=False):
+    '''
+    Yields the format_OSF() table in DataFrames of chunk_size rows, with the
+    'matrix' column already rendered as text. With flat=True the matrix is
+    instead given as numeric columns: the row labels row1..rowd, the column
+    labels col1..cold and the values v1_1..vd_d.
+    '''
+    pd.set_option('display.float_format', '{:.2E}'.format)
+    arrays = format_OSF_arrays(sorted_result_list_np, full_data, list_len)
+    if arrays is None:
+        yield pd.DataFrame([], columns=['rank', 'O score', 'matrix'])
+        return
+    dimension = arrays['rows'].shape[1]
+    for start in range(0, len(arrays['rank']), chunk_size):
+        stop = min(start + chunk_size, len(arrays['rank']))
+        chunk = {'rank': arrays['rank'][start:stop],
+                 'O score': arrays['O score'][start:stop]}
+        if flat:
+            for j in range(dimension):
+                chunk['row{}'.format(j + 1)] = full_data.index[
+                    arrays['rows'][start:stop, j]]
+            for j in range(dimension):
+                chunk['col{}'.format(j + 1)] = full_data.columns[
+                    arrays['cols'][start:stop, j]]
+            for j in range(dimension):
+                for k in range(dimension):
+                    chunk['v{}_{}'.format(j + 1, k + 1)] = arrays[
+                        'values'][start:stop, j, k]
+        else:
+            chunk['matrix'] = _matrix_texts(arrays, full_data, start, stop)
+        for j, label in enumerate(pair_labels(dimension)):
+            if j % 2:
+                chunk[label] = full_data.index[
+                    arrays['pair_rows'][start:stop, j // 2]]
+            else:
+                chunk[label] = full_data.columns[
+                    arrays['pair_cols'][start:stop, j // 2]]
+        yield pd.DataFrame(chunk)
+
+
+OUTPUT_FORMATS = ('csv', 'parquet', 'feather')
+
+
+def _timed(iterator, monitor, stage):
+    '''
+    Passes iterator through, adding the time spent producing each item to a
+    stage on monitor.
+    '''
+    if monitor is None:
+        yield from iterator
+        return
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            monitor.add_time(stage, time.perf_counter() - start)
+        yield item
+
+
+def _add_elapsed(monitor, stage, start):
+    '''
+    Adds the time since start (from time.perf_counter) to a stage on monitor,
+    if there is one.
+    '''
+    if monitor is not None:
+        monitor.add_time(stage, time.perf_counter() - start)
+
+
+def write_OSF(sorted_result_list_np, full_data, path, list_len=1000,
+              chunk_size=1000, file_format=None, monitor=None):
+    '''
+    Streams the formatted results to path in chunks of chunk_size rows.
+    'csv' writes the same file as format_OSF().to_csv(path, index=False).
+    'parquet' and 'feather' (which need pyarrow) write the submatrix as flat
+    numeric columns. The format is taken from the extension of path if not
+    given. Time spent formatting and writing is added to monitor's format and
+    write stages if one is given.
+    '''
+    if file_format is None:
+        extension = os.path.splitext(path)[1].lstrip('.').lower()
+        file_format = extension if extension in OUTPUT_FORMATS else 'csv'
+    chunks = _timed(iter_OSF_chunks(sorted_result_list_np, full_data,
+                                    list_len, chunk_size,
+                                    flat=file_format != 'csv'),
+                    monitor, 'format')
+    if file_format == 'csv':
+        with open(path, 'w', newline='') as output:
+            for i, chunk in enumerate(chunks):
+                start = time.perf_counter()
+                chunk.to_csv(output, index=False, header=(i == 0))
+                _add_elapsed(monitor, 'write', start)
+        return
+    try:
+        import pyarrow as pa
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Writing {} files requires pyarrow. Install it or '
+                          'write a .csv instead.'.format(file_format))
+    if file_format == 'parquet':
+        writer = None
+        try:
+            for chunk in chunks:
+                start = time.perf_counter()
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pa.parquet.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                _add_elapsed(monitor, 'write', start)
+        finally:
+            if writer is not None:
+                start = time.perf_counter()
+                writer.close()
+                _add_elapsed(monitor, 'write', start)
+    elif file_format == 'feather':
+        # Feather files cannot be appended to, but flat chunks are small.
+        tables = []
+        for chunk in chunks:
+            start = time.perf_counter()
+            tables.append(pa.Table.from_pandas(chunk, preserve_index=False))
+            _add_elapsed(monitor, 'write', start)
+        start = time.perf_counter()
+        pa.feather.write_feather(pa.concat_tables(tables), path)
+        _add_elapsed(monitor, 'write', start)
+    else:
+        raise ValueError('Unknown output format: {}'.format(file_format))
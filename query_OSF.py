@@ -0,0 +1,112 @@
+'''
+Queries a result store written by run_OSF.py --store with a .db, .sqlite or
+.sqlite3 file. Requires the orthogonal_set_finder.py file.
+'''
+from orthogonal_set_finder import *
+import argparse
+import os
+import time
+from sys import exit
+from result_store import ResultStore, StoreError
+import n_dim_finder
+
+
+def main():
+    #################################################################
+    # setup parser for accepting arguments from the bash shell
+    parser = argparse.ArgumentParser(
+        description='Returns the best hits saved in an OSF result store.')
+    parser.add_argument('store',
+                        help='The .db, .sqlite or .sqlite3 store.')
+    parser.add_argument('-o', '--output',
+                        help='Output file name. default: only print the best'
+                        ' five hits.', default=None)
+    parser.add_argument('--output_format',
+                        help='Output file format. default: from the output'
+                        ' file extension, else csv.', choices=OUTPUT_FORMATS,
+                        default=None)
+    parser.add_argument('-d', '--dimension',
+                        help='Dimension of the saved search to query.'
+                        ' Default: 2.', default=2, type=int)
+    parser.add_argument('-l', '--length',
+                        help='Number of hits to return. default: 1000.',
+                        default=1000, type=int)
+    parser.add_argument('-t', '--threshold',
+                        help='Only return hits with an RMS below this.'
+                        ' default: that of the saved search.', default=None,
+                        type=float)
+    parser.add_argument('--enzyme',
+                        help='Only return hits that use this enzyme (row'
+                        ' label), from among the saved ones. May be given'
+                        ' more than once.',
+                        action='append', default=[])
+    parser.add_argument('--substrate',
+                        help='Only return hits that use this substrate'
+                        ' (column label), from among the saved ones. May be'
+                        ' given more than once.',
+                        action='append', default=[])
+    parser.add_argument('--networks',
+                        help='Instead of the hits, write the networks of this'
+                        ' dimension among the 2-dimensional hits, as'
+                        ' n_dim_finder.py does. default: off', default=None,
+                        type=int)
+    parser.add_argument('--list',
+                        help='List the searches saved in the store.'
+                        ' default: off', action='store_true')
+    args = vars(parser.parse_args())
+    #################################################################
+    if not os.path.exists(args["store"]):
+        print("Could not find the store {}.".format(args["store"]))
+        return 0
+    try:
+        store = ResultStore(args["store"])
+    except StoreError as error:
+        print(error)
+        return 0
+    with store:
+        if args["list"]:
+            for dimension, search in sorted(store.searches().items()):
+                print('{}x{}: threshold {}, length {}, engine {}'.format(
+                    dimension, dimension, search['threshold'],
+                    search['top_k'], search['engine']))
+            return 1
+        dimension = 2 if args["networks"] else args["dimension"]
+        start = time.perf_counter()
+        try:
+            result = store.query(dimension, threshold=args["threshold"],
+                                 top_k=args["length"],
+                                 enzymes=args["enzyme"],
+                                 substrates=args["substrate"])
+        except KeyError as error:
+            print(error.args[0])
+            return 0
+        print("Found {} hits in {:.1f} ms.".format(
+            len(result), 1000 * (time.perf_counter() - start)))
+        saved = store.searches()[dimension]
+        if (args["threshold"] or 0) > saved['threshold'] or \
+                saved['top_k'] is not None and args["length"] > saved['top_k']:
+            print("Note: only the best {} hits below {} were saved.".format(
+                saved['top_k'], saved['threshold']))
+        full_data = store.data()
+    if args["networks"]:
+        result_df = n_dim_finder.network_table(result, full_data,
+                                               args["networks"],
+                                               args["length"])
+        print("I found {} combinations for {} dimensions.".format(
+            str(len(result_df)), args["networks"]))
+        if args["output"]:
+            result_df.to_csv(args["output"], index=False)
+    else:
+        print("Top five hits:")
+        print(list(result_tuples(result[:5])))
+        if args["output"]:
+            write_OSF(result, full_data, args["output"],
+                      list_len=args["length"],
+                      file_format=args["output_format"])
+    if args["output"]:
+        print('Result saved to {}'.format(args["output"]))
+    return 1
+
+
+if __name__ == '__main__':
+    exit(main())
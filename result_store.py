@@ -0,0 +1,289 @@
+'''
+Saved OSF search results, for run_OSF.py --store and --incremental and for
+query_OSF.py.
+
+A result store is either a single .npz file (save_store(), load_store())
+or an indexed SQLite database (ResultStore). In the latter one
+loose-threshold search is saved once, and the top hits under any
+stricter threshold or shorter list, or only those involving given enzymes or
+substrates, are then a query rather than a new search. A store holds the
+cleaned matrix it was searched on and the sorted results of one search per
+dimension. Query results are result arrays, so they can be passed straight
+to format_OSF(), write_OSF() or n_dim_finder.find_networks() together with
+ResultStore.data().
+'''
+import json
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+from orthogonal_set_finder import (data_hash, index_type, make_results,
+                                   result_dtype)
+
+# Version of both the .npz and the SQLite stores.
+STORE_VERSION = 1
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS matrix (id INTEGER PRIMARY KEY CHECK (id = 0),
+                                   m INTEGER, n INTEGER, data BLOB);
+CREATE TABLE IF NOT EXISTS searches (dimension INTEGER PRIMARY KEY,
+                                     threshold REAL, top_k INTEGER,
+                                     engine TEXT, extra TEXT);
+CREATE TABLE IF NOT EXISTS hits (dimension INTEGER, rank INTEGER, rms REAL,
+                                 rows BLOB, cols BLOB,
+                                 PRIMARY KEY (dimension, rank))
+                                 WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hit_rows (dimension INTEGER, position INTEGER,
+                                     rank INTEGER,
+                                     PRIMARY KEY (dimension, position, rank))
+                                     WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hit_cols (dimension INTEGER, position INTEGER,
+                                     rank INTEGER,
+                                     PRIMARY KEY (dimension, position, rank))
+                                     WITHOUT ROWID;
+'''
+
+
+class StoreError(ValueError):
+    '''
+    Raised when a file is not a result store of this version.
+    '''
+
+
+def is_sqlite_path(path):
+    return os.path.splitext(path)[1].lower() in SQLITE_EXTENSIONS
+
+
+def save_store(path, full_data, results, dimension, threshold, top_k,
+               engine, **extra):
+    '''
+    Saves the sorted results of a finished search together with the cleaned
+    matrix and its labels to a single .npz file, so that a later search of a
+    grown screen can start from them (see
+    orthogonal_set_finder.incremental_search()). Any extra settings are
+    stored in the metadata. Written atomically like a checkpoint.
+    '''
+    meta = dict(version=STORE_VERSION, dimension=dimension,
+                threshold=float(threshold), top_k=top_k, engine=engine,
+                index=full_data.index.tolist(),
+                columns=full_data.columns.tolist(), **extra)
+    with open(path + '.tmp', 'wb') as store_file:
+        np.savez(store_file, meta=np.array(json.dumps(meta)),
+                 results=results, data=np.asarray(full_data.values,
+                                                  dtype='float64'))
+    os.replace(path + '.tmp', path)
+
+
+def load_store(path):
+    '''
+    Reads a file written by save_store(). Returns its metadata, the cleaned
+    matrix as a DataFrame and the sorted result array.
+    '''
+    with np.load(path, allow_pickle=False) as saved:
+        meta = json.loads(str(saved['meta']))
+        if meta.get('version') != STORE_VERSION:
+            raise StoreError('{} is not a result store of this version.'
+                             .format(path))
+        full_data = pd.DataFrame(saved['data'], index=meta['index'],
+                                 columns=meta['columns'])
+        return meta, full_data, saved['results']
+
+
+class ResultStore(object):
+    '''
+    A result store in the SQLite file at path, which is created if needed.
+
+    Hits are kept in the order of the sorted result array, so the best k
+    under a threshold are a prefix of it. They are indexed by dimension and
+    rank, and by every row and column position they use.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(SCHEMA)
+        version = self._meta('version')
+        if version is not None and version != STORE_VERSION:
+            raise StoreError('{} is not a result store of this version.'
+                             .format(path))
+        self._data = None
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _meta(self, key):
+        row = self._connection.execute('SELECT value FROM meta WHERE key = ?',
+                                       (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def data(self):
+        '''
+        The cleaned matrix the results were found in, as a DataFrame.
+        '''
+        if self._data is None:
+            row = self._connection.execute(
+                'SELECT m, n, data FROM matrix').fetchone()
+            if row is None:
+                raise KeyError('{} holds no results yet.'.format(self.path))
+            m, n, data = row
+            self._data = pd.DataFrame(
+                np.frombuffer(data, dtype='float64').reshape(m, n),
+                index=self._meta('index'), columns=self._meta('columns'))
+        return self._data
+
+    def searches(self):
+        '''
+        The settings of the search saved for each dimension, as a dict of
+        dicts keyed by dimension.
+        '''
+        searches = {}
+        for dimension, threshold, top_k, engine, extra in \
+                self._connection.execute('SELECT * FROM searches'):
+            searches[dimension] = dict(json.loads(extra), dimension=dimension,
+                                       threshold=threshold, top_k=top_k,
+                                       engine=engine)
+        return searches
+
+    def save(self, full_data, results, dimension, threshold, top_k, engine,
+             **extra):
+        '''
+        Saves the sorted result array of a search of full_data, replacing
+        any earlier results for that dimension. If full_data differs from
+        the matrix already in the store, the results for the other
+        dimensions no longer apply and are removed. Any extra settings are
+        kept with the search.
+        '''
+        values = np.ascontiguousarray(full_data.values, dtype='float64')
+        digest = data_hash(values)
+        index, columns = full_data.index.tolist(), full_data.columns.tolist()
+        with self._connection as connection:
+            if (self._meta('data'), self._meta('index'),
+                    self._meta('columns')) != (digest, index, columns):
+                for table in ('matrix', 'searches', 'hits', 'hit_rows',
+                              'hit_cols'):
+                    connection.execute('DELETE FROM {}'.format(table))
+                connection.executemany(
+                    'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                    [(key, json.dumps(value)) for key, value in
+                     (('version', STORE_VERSION), ('data', digest),
+                      ('index', index), ('columns', columns))])
+                connection.execute('INSERT INTO matrix VALUES (0, ?, ?, ?)',
+                                   (values.shape[0], values.shape[1],
+                                    values.tobytes()))
+            for table in ('searches', 'hits', 'hit_rows', 'hit_cols'):
+                connection.execute('DELETE FROM {} WHERE dimension = ?'
+                                   .format(table), (dimension,))
+            connection.execute('INSERT INTO searches VALUES (?, ?, ?, ?, ?)',
+                               (dimension, float(threshold), top_k, engine,
+                                json.dumps(extra)))
+            rows = results['rows'].astype(np.int32)
+            cols = results['cols'].astype(np.int32)
+            ranks = range(1, len(results) + 1)
+            connection.executemany(
+                'INSERT INTO hits VALUES (?, ?, ?, ?, ?)',
+                zip([dimension] * len(results), ranks,
+                    results['rms'].tolist(), map(bytes, rows),
+                    map(bytes, cols)))
+            for table, positions in (('hit_rows', rows), ('hit_cols', cols)):
+                connection.executemany(
+                    'INSERT OR IGNORE INTO {} VALUES (?, ?, ?)'.format(table),
+                    ((dimension, position, rank) for rank, combination in
+                     zip(ranks, positions.tolist())
+                     for position in combination))
+        self._data = None
+
+    def _positions(self, labels, axis):
+        axis_labels = self.data().index if axis == 0 else self.data().columns
+        text = [str(label) for label in axis_labels]
+        positions = []
+        for label in labels:
+            if str(label) not in text:
+                raise KeyError('{} is not a{} in {}.'.format(
+                    label, 'n enzyme' if axis == 0 else ' substrate',
+                    self.path))
+            positions.append(text.index(str(label)))
+        return positions
+
+    def query(self, dimension=2, threshold=None, top_k=None, enzymes=(),
+              substrates=()):
+        '''
+        Returns the saved hits of the given dimension as a sorted result
+        array: the best top_k (all if None) with an RMS below threshold (any
+        if None) that use every one of the enzymes and substrates given (as
+        row and column labels). Positions are those of data().
+        '''
+        search = self.searches().get(dimension)
+        if search is None:
+            raise KeyError('{} holds no {}-dimensional results.'.format(
+                self.path, dimension))
+        conditions = ['hits.dimension = ?']
+        parameters = [dimension]
+        for table, labels, axis in (('hit_rows', enzymes, 0),
+                                    ('hit_cols', substrates, 1)):
+            for position in self._positions(labels, axis):
+                conditions.append('hits.rank IN (SELECT rank FROM {} WHERE '
+                                  'dimension = ? AND position = ?)'
+                                  .format(table))
+                parameters += [dimension, position]
+        if threshold is not None:
+            conditions.append('hits.rms < ?')
+            parameters.append(float(threshold))
+        query = ('SELECT rms, rows, cols FROM hits WHERE {} ORDER BY rank'
+                 .format(' AND '.join(conditions)))
+        if top_k is not None:
+            query += ' LIMIT ?'
+            parameters.append(int(top_k))
+        found = self._connection.execute(query, parameters).fetchall()
+        m, n = self.data().shape
+        dtype = result_dtype(dimension, index_type(m, n))
+        if not found:
+            return np.empty(0, dtype=dtype)
+        rms, rows, cols = zip(*found)
+        rows = np.frombuffer(b''.join(rows), np.int32).reshape(-1, dimension)
+        cols = np.frombuffer(b''.join(cols), np.int32).reshape(-1, dimension)
+        return make_results(rms, rows, cols, dtype)
+
+    def load(self, dimension):
+        '''
+        The saved search of the given dimension as load_store() returns it:
+        its settings, the matrix and the sorted result array.
+        '''
+        return (self.searches()[dimension], self.data(),
+                self.query(dimension))
+
+
+def save_results(path, full_data, results, dimension, threshold, top_k,
+                 engine, **extra):
+    '''
+    Saves a search to a SQLite ResultStore if path ends in .db, .sqlite or
+    .sqlite3, else to an .npz file with save_store().
+    '''
+    if not is_sqlite_path(path):
+        return save_store(path, full_data, results, dimension, threshold,
+                          top_k, engine, **extra)
+    with ResultStore(path) as store:
+        store.save(full_data, results, dimension, threshold, top_k, engine,
+                   **extra)
+
+
+def load_results(path, dimension):
+    '''
+    Loads the search of the given dimension saved by save_results(), as
+    load_store() does. Raises FileNotFoundError if there is no such file,
+    KeyError if a SQLite store holds no search of that dimension and
+    StoreError if the file is not a store of this version.
+    '''
+    if not is_sqlite_path(path):
+        return load_store(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    with ResultStore(path) as store:
+        return store.load(dimension)
@@ -4,50 +4,253 @@ Runs OSF search in the terminal. Requires the orthogonal_set_finder.py file.
 from orthogonal_set_finder import *
 import argparse
 import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import pandas as pd
 from multiprocessing import Pool
-from itertools import repeat, chain
 from sys import getsizeof, exit
+from search_monitor import RunMonitor
+from result_store import StoreError, load_results, save_results
+from search_planner import plan_search, plan_summary
 
 
-def buffer_generator(generator, buffer_length):
+def run_multiprocess(full_data, dimension, numProcesses=2, threshold=1,
+                     buffer_length=1000000, top_k=None, task_size=None,
+                     stats=None, engine='brute', monitor=None,
+                     checkpoint=None, checkpoint_interval=600, resume=False,
+                     shard=None):
     '''
-    Generator to buffer a longer generator into chunks that can be distributed
-    to child processes.
+    Method to run OSF search in multiple processes simultaneously.
+
+    The data matrix is published once in shared memory and the combination
+    space is streamed to the processes as many small (start_rank, count)
+    tasks, which they enumerate themselves. Finished tasks are reduced as they
+    arrive, so no process waits on the others between chunks; at most
+    buffer_length combinations are in flight at a time. Each process keeps
+    its best top_k results in a TopK result array and the parent merges them,
+    so memory stays at O(top_k x numProcesses) rather than growing with the
+    number of hits. The current k-th best RMS is handed out with every new
+    task as a tightening cutoff. top_k=None keeps every result below the
+    threshold. Per-worker task counts are recorded in stats if given.
+    engine='bnb' runs the exact branch-and-bound search instead of
+    enumerating every combination; the results are the same. Progress is
+    reported to monitor (a search_monitor.RunMonitor) if given. If checkpoint
+    is a path, progress is saved there every checkpoint_interval seconds and
+    resume=True continues from it. shard=(i, N) only searches the i-th of N
+    slices of the combinations.
     '''
-    more_values = True  # So long as generator starts out with values.
-    while more_values:
-        sublist = []
-        for c in range(buffer_length):
-            try:
-                sublist.append(next(generator))
-            except StopIteration:
-                more_values = False
-        yield sublist
+    with Pool(processes=numProcesses) as pool:
+        return pool_search(pool, full_data.values, dimension,
+                           numProcesses=numProcesses, threshold=threshold,
+                           top_k=top_k, buffer_length=buffer_length,
+                           task_size=task_size, stats=stats, engine=engine,
+                           monitor=monitor, checkpoint=checkpoint,
+                           checkpoint_interval=checkpoint_interval,
+                           resume=resume, shard=shard)
 
 
-def run_multiprocess(full_data, dimension, numProcesses=2, threshold=1,
-                     buffer_length=1000000):
+def run_beam(full_data, dimension, numProcesses=2, threshold=1, top_k=None,
+             width=16, time_budget=60, restarts=None, seed=0, stats=None):
     '''
-    Method to run OSF search in multiple processes simultaneously.
+    Runs the approximate beam search (see beam_search()) in multiple
+    processes, each working for time_budget seconds from its own seeds.
+    '''
+    with Pool(processes=numProcesses) as pool:
+        return beam_search(pool, full_data.values, dimension,
+                           numProcesses=numProcesses, threshold=threshold,
+                           top_k=top_k, width=width, time_budget=time_budget,
+                           restarts=restarts, seed=seed, stats=stats)
+
+
+def run_incremental(full_data, previous, dimension, numProcesses=2,
+                    threshold=1, top_k=None, engine='brute', task_size=None,
+                    stats=None, monitor=None):
+    '''
+    Updates the results of an earlier run, as loaded with load_results(),
+    for a grown or edited matrix by only searching the combinations that use
+    a new or changed enzyme or substrate (see incremental_search()).
+    '''
+    with Pool(processes=numProcesses) as pool:
+        return incremental_search(pool, full_data, previous, dimension,
+                                  numProcesses=numProcesses,
+                                  threshold=threshold, top_k=top_k,
+                                  engine=engine, task_size=task_size,
+                                  stats=stats, monitor=monitor)
+
+
+# Settings a --batch job may not use, as they need a run of their own.
+BATCH_UNSUPPORTED = ('shard', 'incremental', 'compare', 'batch')
+
+# Exit status of a --batch run in which a job failed. The other runs exit
+# with 1 when they finish and 0 when they fail, so a failed batch needs a
+# status of its own.
+BATCH_FAILED = 2
+
+
+def batch_errors(jobs):
+    '''
+    The problems with a list of --batch job configurations that would stop
+    a job before it starts, as a list of messages (empty if there are none).
+    '''
+    errors = []
+    for number, job in enumerate(jobs, 1):
+        if not isinstance(job, dict):
+            errors.append('job {} is not a config.'.format(number))
+            continue
+        missing = [key for key in ('input', 'output') if not job.get(key)]
+        if missing:
+            errors.append('job {} has no {}.'.format(number,
+                                                     ' or '.join(missing)))
+        unsupported = [key for key in BATCH_UNSUPPORTED if job.get(key)]
+        if unsupported:
+            errors.append('job {} uses {}, which cannot be used in a batch.'
+                          .format(number, ', '.join(unsupported)))
+    return errors
+
+
+def run_batch_job(pool, conf, full_data, data_spec, numProcesses=1):
+    '''
+    Runs one job of a batch on the shared pool, with the matrix already
+    loaded (full_data) and published in shared memory (data_spec). Progress,
+    results and stage timings go to the job's own log file, conf["log"] or
+    else the output path with .log added. Returns True if the job finished.
     '''
-    if __name__ == '__main__':
-        buffer_list = buffer_generator(every_matrix(
-            dimension, dimension, full_data), buffer_length)
-        pool = Pool(processes=numProcesses)
-        identityMat = np.eye(dimension)
-        full_data_np = full_data.values
-        compiled_chunks = []
-        for chunk in buffer_list:
-            list_of_combinations = [chunk[i::numProcesses] for i in range(
-                numProcesses)]
-            result_list = pool.starmap(iterate_RMSs, zip(
-                list_of_combinations, repeat(full_data_np.copy()), repeat(
-                    identityMat), repeat(threshold)))
-            merged_pool = list(chain.from_iterable(result_list))
-            compiled_chunks.extend(merged_pool)
-        return sorted(compiled_chunks, key=lambda x: x[0])
+    log_path = conf.get("log") or conf["output"] + '.log'
+    try:
+        log = open(log_path, 'w')
+    except OSError as error:
+        print('Could not open the log {}: {}'.format(log_path, error),
+              flush=True)
+        return False
+    with log:
+        monitor = None
+        try:
+            monitor = RunMonitor(interval=conf.get("progress_interval", 60),
+                                 metrics_path=conf.get("metrics"), stream=log)
+            print('Running a {}x{} matrix search on {} with {} shared'
+                  ' process(es). Threshold set to {}.'.format(
+                      conf["dimension"], conf["dimension"], conf["input"],
+                      numProcesses, conf["threshold"]), file=log, flush=True)
+            search_data, search_spec = full_data, data_spec
+            if conf.get("prefilter"):
+                with monitor.stage('prefilter'):
+                    search_data, positions, report = prefilter_data(
+                        full_data, conf["dimension"], conf["threshold"])
+                # The reduced matrix is shared by pool_search() itself.
+                search_spec = None
+                print(prefilter_summary(report), file=log, flush=True)
+            engine = conf.get("engine", "brute")
+            if engine in APPROXIMATE_ENGINES:
+                with monitor.stage('search'):
+                    result = beam_search(
+                        pool, search_data.values, conf["dimension"],
+                        numProcesses=numProcesses,
+                        threshold=conf["threshold"], top_k=conf["length"],
+                        width=conf.get("beam_width", 16),
+                        time_budget=conf.get("time_budget", 60),
+                        seed=conf.get("seed", 0), data_spec=search_spec)
+            else:
+                result = pool_search(
+                    pool, search_data.values, conf["dimension"],
+                    numProcesses=numProcesses, threshold=conf["threshold"],
+                    top_k=conf["length"],
+                    buffer_length=conf.get("buffer_length", 1000000),
+                    task_size=conf.get("task_size"), engine=engine,
+                    monitor=monitor, checkpoint=conf.get("checkpoint"),
+                    checkpoint_interval=conf.get("checkpoint_interval", 600),
+                    resume=conf.get("resume", False), data_spec=search_spec)
+            if conf.get("prefilter"):
+                result = expand_results(result, positions, full_data.shape)
+            print("Top five hits:", file=log)
+            print(list(result_tuples(result[:5])), file=log)
+            print("I kept the best {} combinations.".format(len(result)),
+                  file=log, flush=True)
+            if not conf.get("time_testing"):
+                write_OSF(result, full_data, conf["output"],
+                          list_len=conf["length"],
+                          file_format=conf.get("output_format"),
+                          monitor=monitor)
+                print('Result saved to {}'.format(conf["output"]), file=log)
+            if conf.get("store"):
+                save_results(conf["store"], full_data, result,
+                             conf["dimension"], conf["threshold"],
+                             conf["length"], engine,
+                             floor=conf.get("floor", 1000))
+                print('Result store saved to {}'.format(conf["store"]),
+                      file=log)
+            if conf.get("checkpoint") and os.path.exists(conf["checkpoint"]):
+                os.remove(conf["checkpoint"])
+            monitor.summary()
+            return True
+        except Exception:
+            traceback.print_exc(file=log)
+            return False
+        finally:
+            if monitor is not None:
+                monitor.close()
+
+
+def run_batch(jobs, numProcesses=1, concurrency=1):
+    '''
+    Runs a list of job configurations (with the keys of a config file) in
+    one allocation. Jobs are grouped by input file and floor so that each
+    matrix is loaded, cleaned and published in shared memory once, and every
+    search runs on one Pool of numProcesses processes; up to concurrency
+    jobs search side by side on it, their tasks interleaved. Each job writes
+    its own output and log (see run_batch_job()). The jobs are expected to
+    have passed batch_errors(). Returns the list of jobs that failed.
+    '''
+    datasets = {}
+    for job in jobs:
+        key = (job["input"], job.get("floor", 1000))
+        if key in datasets:
+            continue
+        start = time.perf_counter()
+        try:
+            datasets[key] = load_data(job["input"], floor=key[1],
+                                      cache=job.get("cache", False))
+            print('Loaded {} ({}x{}) in {:.2f} s.'.format(
+                job["input"], *datasets[key].shape,
+                time.perf_counter() - start))
+        except (OSError, ValueError, IndexError) as error:
+            datasets[key] = None
+            print('Could not load {}: {}'.format(job["input"], error))
+    shared = {}
+    failed = []
+    try:
+        for key, full_data in datasets.items():
+            if full_data is not None:
+                shared[key] = share_data(full_data.values)
+        with Pool(processes=numProcesses) as pool:
+
+            def run(number, job):
+                key = (job["input"], job.get("floor", 1000))
+                if datasets[key] is None:
+                    print('[job {}] FAILED: could not load {}'.format(
+                        number, job["input"]), flush=True)
+                    return False
+                start = time.perf_counter()
+                print('[job {}] started: {}'.format(number, job["output"]),
+                      flush=True)
+                finished = run_batch_job(pool, job, datasets[key],
+                                         shared[key][1], numProcesses)
+                print('[job {}] {} in {:.2f} s: {}'.format(
+                    number, 'finished' if finished else 'FAILED',
+                    time.perf_counter() - start, job["output"]), flush=True)
+                return finished
+
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                outcomes = list(executor.map(run, range(1, len(jobs) + 1),
+                                             jobs))
+        failed = [job for job, finished in zip(jobs, outcomes)
+                  if not finished]
+    finally:
+        for shm, data_spec in shared.values():
+            shm.close()
+            shm.unlink()
+    return failed
 
 
 def main():
@@ -62,6 +265,11 @@ def main():
                         'mutants in rows.')
     parser.add_argument('-o', '--output',
                         help='Output file name as .csv')
+    parser.add_argument('--output_format',
+                        help='Output file format. parquet and feather store the'
+                        ' submatrix as numeric columns and need pyarrow.'
+                        ' default: from the output file extension, else csv.',
+                        choices=OUTPUT_FORMATS, default=None)
     parser.add_argument('-d', '--dimension',
                         help='Dimension of search. Default: 2.', default=2,
                         type=int)
@@ -72,20 +280,136 @@ def main():
                         help='Length of result list to print to csv.'
                         'default: 1000.', default=1000, type=int)
     parser.add_argument('-t', '--threshold',
-                        help='Number below which RMSs should be kept. Setting to a'
-                        'lower number (0.15) reduces memory usage for larger'
-                        'dimension searches. default: 1.', default=1, type=float)
+                        help='Number below which RMSs should be kept. Only the'
+                        ' best LENGTH results are held in memory, so this is'
+                        ' no longer needed to limit memory usage. default: 1.',
+                        default=1, type=float)
     parser.add_argument('-b', '--buffer_length',
                         help='Length of list to buffer into memory. Should be'
                         'larger when using more processes. default: 1E6.',
                         default=1000000, type=int)
+    parser.add_argument('-s', '--task_size',
+                        help='Number of combinations handed to a process at a'
+                        ' time. default: chosen from the search size.',
+                        default=None, type=int)
+    parser.add_argument('--engine',
+                        help='Search engine. brute checks every combination,'
+                        ' bnb is an exact branch-and-bound search that skips'
+                        ' column sets which cannot make the list. Best for'
+                        ' dimensions of 3 and up. beam is an approximate'
+                        ' search for dimensions too large to search in full;'
+                        ' see --time_budget. default: brute.',
+                        choices=sorted(SEARCH_ENGINES) +
+                        list(APPROXIMATE_ENGINES), default='brute')
+    parser.add_argument('--time_budget',
+                        help='Seconds the beam engine searches for.'
+                        ' default: 60.', default=60, type=float)
+    parser.add_argument('--beam_width',
+                        help='Number of partial sets each beam process keeps'
+                        ' at every size. default: 16.', default=16, type=int)
+    parser.add_argument('--seed',
+                        help='Random seed of the beam engine. default: 0.',
+                        default=0, type=int)
+    parser.add_argument('--compare',
+                        help='After a beam search, also run the exact bnb'
+                        ' search and report how many of its results the beam'
+                        ' found. Only feasible for smaller searches.'
+                        ' default: off', action='store_true')
+    parser.add_argument('--floor',
+                        help='Values below this are raised to it before the'
+                        ' search. default: 1E3.', default=1000, type=float)
+    parser.add_argument('--cache',
+                        help='Keep the cleaned matrix in a binary cache next to'
+                        ' the input so later runs skip parsing and cleaning.'
+                        ' default: off', action='store_true')
+    parser.add_argument('--progress_interval',
+                        help='Seconds between progress lines (percent done,'
+                        ' throughput, ETA, memory). 0 only reports at the end'
+                        ' of the search. default: 60.', default=60, type=float)
+    parser.add_argument('--metrics',
+                        help='Also append the progress and stage timings to'
+                        ' this file as JSON lines. default: off', default=None)
+    parser.add_argument('--checkpoint',
+                        help='Periodically save the finished part of the search'
+                        ' and the results kept so far to this file, so that a'
+                        ' killed run can be resumed. It is removed once the'
+                        ' output is saved. default: off', default=None)
+    parser.add_argument('--checkpoint_interval',
+                        help='Seconds between checkpoints. default: 600.',
+                        default=600, type=float)
+    parser.add_argument('--resume',
+                        help='Continue from the --checkpoint file if it exists.'
+                        ' The input and search settings must be the same.'
+                        ' default: off', action='store_true')
+    parser.add_argument('--prefilter',
+                        help='Before the search, drop the enzymes and'
+                        ' substrates that provably cannot be part of a hit'
+                        ' below the threshold (e.g. uniformly bright mutants).'
+                        ' The results are unchanged. default: off',
+                        action='store_true')
+    parser.add_argument('--shard',
+                        help='Only search shard i of N (written i/N, counting'
+                        ' from 1) and save its results to OUTPUT.shard-i-of-N'
+                        '.npz for merge_OSF.py. Overrides the config file.'
+                        ' default: off', type=parse_shard, default=None)
+    parser.add_argument('--store',
+                        help='Also save the results with the cleaned matrix'
+                        ' to this file, for a later --incremental run. A .db,'
+                        ' .sqlite or .sqlite3 file is an indexed store that'
+                        ' query_OSF.py can search; anything else is written'
+                        ' as .npz. default: off', default=None)
+    parser.add_argument('--incremental',
+                        help='Start from the results in the --store file and'
+                        ' only search the combinations that use an enzyme or'
+                        ' substrate that is new or changed since; the store'
+                        ' is then updated. The results are the same as a'
+                        ' full search. default: off', action='store_true')
+    parser.add_argument('--batch',
+                        help='Run every job in this JSON list of configs'
+                        ' (with the keys of a config file) on one pool of'
+                        ' PROCESSES processes, loading each input once. Each'
+                        ' job writes its output and OUTPUT.log. default: off',
+                        default=None)
+    parser.add_argument('--concurrency',
+                        help='Number of --batch jobs that run at the same time'
+                        ' on the shared processes. default: 1.', default=1,
+                        type=int)
+    parser.add_argument('--plan',
+                        help='Only estimate the run: count the combinations,'
+                        ' time the engine on a sample of them, and print the'
+                        ' predicted time, memory and output size with'
+                        ' recommended settings. default: off',
+                        action='store_true')
+    parser.add_argument('--auto',
+                        help='Make the --plan estimate, then run with the'
+                        ' recommended number of processes and buffer length.'
+                        ' default: off', action='store_true')
     parser.add_argument('-e', '--time_testing',
                         help='Use to test speed of algorithm. Restricts printed'
                         ' and csv output. default: off', action='store_true')
     args = vars(parser.parse_args())
     #################################################################
+    if args["batch"] is not None:
+        # Jobs fall back to the defaults of the flags above.
+        defaults = vars(parser.parse_args([]))
+        jobs = json.load(open(args["batch"]))
+        errors = batch_errors(jobs)
+        if errors:
+            print('Not starting the batch:')
+            print('\n'.join('  ' + error for error in errors))
+            return BATCH_FAILED
+        jobs = [dict(defaults, **job) for job in jobs]
+        print('Running {} jobs with {} process(es), {} at a time.'.format(
+            len(jobs), args["processes"], args["concurrency"]))
+        failed = run_batch(jobs, numProcesses=args["processes"],
+                           concurrency=args["concurrency"])
+        print('{} of {} jobs finished.'.format(len(jobs) - len(failed),
+                                               len(jobs)))
+        return BATCH_FAILED if failed else 1
     if args["config_file"] != None:
         conf = json.load(open(args["config_file"]))
+        if args["shard"] is not None:
+            conf["shard"] = args["shard"]
     else:
         conf = args
     # run the script printing start and end times and the top five hits at the
@@ -95,8 +419,12 @@ def main():
               'Threshold set to {}.'.format(conf["dimension"], conf["dimension"],
                                             conf["input"], conf["processes"],
                                             conf["threshold"]))
+    monitor = RunMonitor(interval=conf.get("progress_interval", 60),
+                         metrics_path=conf.get("metrics"),
+                         quiet=conf["time_testing"])
     try:
-        full_data = pd.read_csv(conf["input"], index_col=0, dtype='float64')
+        full_data = load_data(conf["input"], floor=conf.get("floor", 1000),
+                              cache=conf.get("cache", False), monitor=monitor)
     except FileNotFoundError:
         print("Could not find the file in the specified path: {}. "
               "Please check the file/path.".format(conf["input"]))
@@ -110,31 +438,164 @@ def main():
               " extraneous commas in the .csv file.")
         return 0
     #    raise
+    search_data = full_data
+    if conf.get("prefilter"):
+        with monitor.stage('prefilter'):
+            search_data, positions, report = prefilter_data(
+                full_data, conf["dimension"], conf["threshold"])
+        if not conf["time_testing"]:
+            print(prefilter_summary(report))
+    if conf.get("plan") or conf.get("auto"):
+        engine = conf.get("engine", "brute")
+        if engine in APPROXIMATE_ENGINES:
+            print("The {} engine runs for --time_budget seconds, so there is"
+                  " nothing to plan.".format(engine))
+            return 0
+        with monitor.stage('plan'):
+            plan = plan_search(search_data, conf["dimension"],
+                               processes=conf["processes"],
+                               threshold=conf["threshold"],
+                               top_k=conf["length"], engine=engine)
+        print('\n'.join(plan_summary(plan)))
+        if not conf.get("auto"):
+            monitor.close()
+            return 1
+        conf["processes"] = plan["recommended_processes"]
+        conf["buffer_length"] = plan["recommended_buffer_length"]
+        print('Running with {} process(es) and a buffer length of {}.'.format(
+            conf["processes"], conf["buffer_length"]))
     starttime = datetime.now()
     if not conf["time_testing"]:
         print('Start time: {}'.format(starttime.isoformat()))
-    # prep the raw data for processing:
-    full_data.index = full_data.index.map(int)  # Allows m numbers to
-    # format properly.
-    clean_raw_data(full_data)  # Set everything below 1E3 to 1E3.
     # Start the algorithm.
-    result = run_multiprocess(full_data, conf["dimension"],
-                              numProcesses=conf["processes"],
-                              threshold=conf["threshold"],
-                              buffer_length=conf["buffer_length"])
+    stats = {}
+    checkpoint = conf.get("checkpoint")
+    shard = conf.get("shard")
+    if isinstance(shard, str):
+        shard = parse_shard(shard)
+    engine = conf.get("engine", "brute")
+    if engine in APPROXIMATE_ENGINES and (checkpoint or shard):
+        print("The {} engine does not support --checkpoint or --shard."
+              .format(engine))
+        return 0
+    store = conf.get("store")
+    if shard and store:
+        print("--store cannot be used with --shard; merge the shards first.")
+        return 0
+    previous = None
+    if conf.get("incremental"):
+        if not store or checkpoint or conf.get("prefilter") or \
+                engine in APPROXIMATE_ENGINES:
+            print("--incremental needs --store and cannot be used with"
+                  " --checkpoint, --prefilter or the beam engine.")
+            return 0
+        try:
+            previous = load_results(store, conf["dimension"])
+        except (FileNotFoundError, KeyError):
+            print("There are no results for this search in {} yet, so the"
+                  " whole matrix will be searched.".format(store))
+        except StoreError as error:
+            print(error)
+            return 0
+    try:
+        if previous is not None:
+            result = run_incremental(full_data, previous, conf["dimension"],
+                                     numProcesses=conf["processes"],
+                                     threshold=conf["threshold"],
+                                     top_k=conf["length"], engine=engine,
+                                     task_size=conf.get("task_size"),
+                                     stats=stats, monitor=monitor)
+            if stats["full"]:
+                print("Searched the whole matrix, as {}.".format(
+                    stats["full"]))
+            else:
+                print("{} new or changed enzymes and {} substrates: searched"
+                      " {:,} of {:,} combinations.".format(
+                          stats["new_rows"], stats["new_cols"],
+                          stats["scored"], count_combinations(
+                              full_data.shape[0], full_data.shape[1],
+                              conf["dimension"])))
+        elif engine in APPROXIMATE_ENGINES:
+            with monitor.stage('search'):
+                result = run_beam(search_data, conf["dimension"],
+                                  numProcesses=conf["processes"],
+                                  threshold=conf["threshold"],
+                                  top_k=conf["length"],
+                                  width=conf.get("beam_width", 16),
+                                  time_budget=conf.get("time_budget", 60),
+                                  seed=conf.get("seed", 0), stats=stats)
+        else:
+            result = run_multiprocess(search_data, conf["dimension"],
+                                      numProcesses=conf["processes"],
+                                      threshold=conf["threshold"],
+                                      buffer_length=conf["buffer_length"],
+                                      top_k=conf["length"],
+                                      task_size=conf.get("task_size"),
+                                      stats=stats, engine=engine,
+                                      monitor=monitor, checkpoint=checkpoint,
+                                      checkpoint_interval=conf.get(
+                                          "checkpoint_interval", 600),
+                                      resume=conf.get("resume", False),
+                                      shard=shard)
+    except CheckpointError as error:
+        print(error)
+        print("Remove it or run without --resume to start over.")
+        return 0
     endtime = datetime.now()
+    if engine in APPROXIMATE_ENGINES and conf.get("compare"):
+        with monitor.stage('compare'):
+            exact = run_multiprocess(search_data, conf["dimension"],
+                                     numProcesses=conf["processes"],
+                                     threshold=conf["threshold"],
+                                     top_k=conf["length"], engine='bnb')
+        comparison = compare_results(result, exact)
+        print("Compared with the exact search: found {:.1%} of its {} "
+              "results, best RMS {} vs {} (exact rank {}).".format(
+                  comparison['recall'], comparison['exhaustive'],
+                  comparison['found_best_rms'],
+                  comparison['exhaustive_best_rms'],
+                  comparison['found_best_rank']))
+    if conf.get("prefilter"):
+        result = expand_results(result, positions, full_data.shape)
     if not conf["time_testing"]:
         print("Done! Top five hits:")
-        print(result[:5])
-        print("I found {} combinations.".format(str(len(result))))
+        print(list(result_tuples(result[:5])))
+        print("I kept the best {} combinations.".format(str(len(result))))
+        if engine in APPROXIMATE_ENGINES:
+            print("Combinations scored per process: {}, restarts: {}".format(
+                sorted(stats["evaluations_per_worker"].values(), reverse=True),
+                sorted(stats["restarts_per_worker"].values(), reverse=True)))
+        elif previous is None:
+            print("Tasks completed per process: {}".format(
+                sorted(stats["tasks_per_worker"].values(), reverse=True)))
         print('End time: {}'.format(endtime.isoformat()))
     print('Total calculation time: {}'.format(str(endtime - starttime)))
 
-    if not conf["time_testing"]:
-        format_OSF(result, full_data,
-                   list_len=conf["length"]).to_csv(conf["output"],
-                                                   index=False)  # Write out result.
+    if shard is not None:
+        partial = shard_path(conf["output"], shard)
+        save_shard(partial, search_data.values, result, conf["dimension"],
+                   conf["threshold"], conf["length"],
+                   conf.get("engine", "brute"), shard,
+                   floor=conf.get("floor", 1000),
+                   prefilter=bool(conf.get("prefilter")),
+                   output_format=conf.get("output_format"))
+        print('Shard {}/{} saved to {}'.format(shard[0], shard[1], partial))
+        monitor.summary()
+    elif not conf["time_testing"]:
+        write_OSF(result, full_data, conf["output"], list_len=conf["length"],
+                  file_format=conf.get("output_format"),
+                  monitor=monitor)  # Write out result.
         print('Result saved to {}'.format(conf["output"]))
+        monitor.summary()
+    if store and shard is None:
+        save_results(store, full_data, result, conf["dimension"],
+                     conf["threshold"], conf["length"], engine,
+                     floor=conf.get("floor", 1000))
+        if not conf["time_testing"]:
+            print('Result store saved to {}'.format(store))
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    monitor.close()
     return 1
 
 
@@ -0,0 +1,187 @@
+'''
+Progress, throughput and timing instrumentation for long OSF runs.
+
+A RunMonitor prints periodic progress lines (to the job's .log) and can
+also write the same metrics as JSON lines to a file for later analysis.
+'''
+import json
+import os
+import resource
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+
+def current_rss_mb():
+    '''
+    Resident memory of this process in MB. Uses /proc where available and
+    falls back to the peak RSS elsewhere.
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+        scale = 1 if os.uname().sysname == 'Darwin' else 1024
+        return peak * scale / 2 ** 20
+
+
+class RunMonitor(object):
+    '''
+    Tracks the stages of a run and the progress of its searches.
+
+    interval is the number of seconds between progress lines (0 to only
+    print when a search ends). If metrics_path is given, every progress line
+    and stage timing is also appended to it as a JSON object per line. Lines
+    are printed to stream (an open text file) if given, else to stdout.
+    '''
+
+    def __init__(self, interval=60, metrics_path=None, quiet=False,
+                 stream=None):
+        self.interval = interval
+        self.quiet = quiet
+        self.stream = stream
+        self.stages = OrderedDict()
+        self._metrics = open(metrics_path, 'a') if metrics_path else None
+        self._search = None
+
+    def close(self):
+        if self._metrics is not None:
+            self._metrics.close()
+            self._metrics = None
+
+    def _emit(self, record):
+        if self._metrics is not None:
+            record = dict(record, time=datetime.now().isoformat())
+            self._metrics.write(json.dumps(record) + '\n')
+            self._metrics.flush()
+
+    def _print(self, line):
+        if not self.quiet:
+            print(line, file=self.stream, flush=True)
+
+    def add_time(self, stage, seconds):
+        '''
+        Adds seconds to a stage, for stages that are timed in pieces.
+        '''
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Context manager that times one stage of the run.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add_time(name, seconds)
+            self._emit({'event': 'stage', 'stage': name, 'seconds': seconds,
+                        'rss_mb': current_rss_mb()})
+
+    def begin_search(self, total, processes, label='search', completed=0):
+        '''
+        Starts tracking a search over total combinations, of which completed
+        were already checked (e.g. by a run that is being resumed).
+        '''
+        now = time.perf_counter()
+        self._search = {'label': label, 'total': total,
+                        'processes': processes, 'completed': completed,
+                        'resumed': completed, 'kept': 0, 'cutoff': None,
+                        'start': now, 'last_report': now, 'workers': {}}
+        if completed:
+            self._print('[{}] Resuming with {:,} of {:,} combinations already'
+                        ' checked, using {} process(es).'.format(
+                            label, completed, total, processes))
+        else:
+            self._print('[{}] {:,} combinations to check with {} process(es).'
+                        .format(label, total, processes))
+
+    def task_done(self, pid, combinations, seconds, kept, cutoff=None):
+        '''
+        Records a finished task: the worker that ran it, the combinations it
+        covered, the seconds it took and the hits kept so far.
+        '''
+        search = self._search
+        worker = search['workers'].setdefault(
+            pid, {'tasks': 0, 'combinations': 0, 'seconds': 0.0})
+        worker['tasks'] += 1
+        worker['combinations'] += combinations
+        worker['seconds'] += seconds
+        search['completed'] += combinations
+        search['kept'] = kept
+        search['cutoff'] = cutoff
+        if self.interval and (time.perf_counter() - search['last_report'] >=
+                              self.interval):
+            self.report()
+
+    def snapshot(self):
+        '''
+        Current progress of the search as a dict.
+        '''
+        search = self._search
+        now = time.perf_counter()
+        elapsed = now - search['start']
+        rate = ((search['completed'] - search['resumed']) / elapsed
+                if elapsed > 0 else 0.0)
+        remaining = search['total'] - search['completed']
+        workers = {}
+        for pid, worker in search['workers'].items():
+            workers[str(pid)] = dict(worker, combinations_per_second=(
+                worker['combinations'] / worker['seconds']
+                if worker['seconds'] > 0 else 0.0))
+        return {'event': 'progress',
+                'stage': search['label'],
+                'total': search['total'],
+                'completed': search['completed'],
+                'fraction': (search['completed'] / search['total']
+                             if search['total'] else 1.0),
+                'elapsed_seconds': elapsed,
+                'combinations_per_second': rate,
+                'eta_seconds': remaining / rate if rate > 0 else None,
+                'kept': search['kept'],
+                'cutoff': search['cutoff'],
+                'rss_mb': current_rss_mb(),
+                'workers': workers}
+
+    def report(self):
+        '''
+        Prints (and records) one progress line.
+        '''
+        snapshot = self.snapshot()
+        self._search['last_report'] = time.perf_counter()
+        rates = [worker['combinations_per_second']
+                 for worker in snapshot['workers'].values()]
+        eta = ('unknown' if snapshot['eta_seconds'] is None else
+               str(timedelta(seconds=round(snapshot['eta_seconds']))))
+        self._print(
+            '[{}] {:.1%} done ({:,}/{:,}), {:,.0f} combos/s overall, '
+            '{:,.0f}-{:,.0f} combos/s per worker, {:,} hits kept, ETA {}, '
+            'memory {:.0f} MB'.format(
+                snapshot['stage'], snapshot['fraction'],
+                snapshot['completed'], snapshot['total'],
+                snapshot['combinations_per_second'],
+                min(rates) if rates else 0, max(rates) if rates else 0,
+                snapshot['kept'], eta, snapshot['rss_mb']))
+        self._emit(snapshot)
+
+    def end_search(self):
+        if self._search is not None:
+            self.report()
+            self._search = None
+
+    def summary(self):
+        '''
+        Prints the time spent in each stage.
+        '''
+        total = sum(self.stages.values())
+        self._print('Stage timings: ' + ', '.join(
+            '{} {:.2f} s'.format(name, seconds)
+            for name, seconds in self.stages.items()) +
+            ' (total {:.2f} s)'.format(total))
+        self._emit({'event': 'summary', 'stages': dict(self.stages),
+                    'total_seconds': total})
@@ -0,0 +1,260 @@
+'''
+Dry-run cost planner for OSF searches.
+
+plan_search() counts the combinations of a search exactly, times the
+search engine on a few random ranges of them and scores a random sample to
+estimate the hit rate. From these it predicts the wall time, peak memory and
+output size of the run and recommends the number of processes, the buffer
+length and a threshold.
+'''
+import os
+import time
+from datetime import timedelta
+from math import comb
+from multiprocessing import cpu_count
+import numpy as np
+import orthogonal_set_finder as osf
+from search_monitor import current_rss_mb
+
+# Hits to aim for per result kept when recommending a threshold, as the
+# hit rate is only estimated from a sample.
+THRESHOLD_MARGIN = 4
+
+# Sampled RMSs that must fall below a recommended threshold for it to be
+# trusted.
+MIN_SAMPLED_HITS = 30
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return cpu_count()
+
+
+def available_memory_mb():
+    '''
+    Memory available to new processes in MB, or None where it is unknown.
+    '''
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return (os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') /
+                2 ** 20)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def sample_RMSs(full_data_np, dimension, size=20000, seed=0):
+    '''
+    RMSs of size combinations drawn uniformly at random (with replacement).
+    '''
+    m, n = full_data_np.shape
+    rng = np.random.default_rng(seed)
+    rows = osf.unrank_combinations(
+        rng.integers(0, comb(m, dimension), size), m, dimension)
+    cols = osf.unrank_combinations(
+        rng.integers(0, comb(n, dimension), size), n, dimension)
+    return osf.batch_RMSs(full_data_np, rows, cols), rows, cols
+
+
+def measure_throughput(full_data_np, dimension, threshold=1, engine='brute',
+                       time_budget=2, seed=0):
+    '''
+    Runs the engine's worker in this process on random ranges of its rank
+    space, doubling their size until time_budget seconds are spent, and
+    returns the combinations covered per second by one process and the
+    seconds timed. The first range only warms up and is not counted.
+    '''
+    m, n = full_data_np.shape
+    worker, space = osf.SEARCH_ENGINES[engine]
+    total = space(m, n, dimension)
+    per_rank = osf.count_combinations(m, n, dimension) // max(total, 1)
+    rng = np.random.default_rng(seed)
+    shm, data_spec = osf.share_data(full_data_np)
+    count = 1 if engine == 'bnb' else 1024
+    covered, seconds = 0, 0.0
+    try:
+        worker(data_spec, dimension, 0, min(count, total), threshold)
+        while seconds < time_budget and total:
+            count = min(count, total)
+            start = int(rng.integers(0, total - count + 1))
+            begin = time.perf_counter()
+            worker(data_spec, dimension, start, count, threshold)
+            elapsed = time.perf_counter() - begin
+            covered += count * per_rank
+            seconds += elapsed
+            if count == total:
+                break
+            if elapsed < time_budget / 8:
+                count *= 2
+    finally:
+        # The worker attached to the block in this process too.
+        osf.detach_shared_data(data_spec)
+        shm.close()
+        shm.unlink()
+    return covered / seconds if seconds > 0 else float('inf'), seconds
+
+
+def _csv_bytes_per_hit(full_data, rms, rows, cols, dimension):
+    '''
+    Average size of a line of the run_OSF.py output, from the best sampled
+    combinations.
+    '''
+    m, n = full_data.shape
+    best = np.argsort(rms)[:50]
+    results = osf.sort_results(osf.make_results(
+        rms[best], np.sort(rows[best], axis=1), np.sort(cols[best], axis=1),
+        osf.result_dtype(dimension, osf.index_type(m, n))))
+    chunk = next(osf.iter_OSF_chunks(results, full_data, len(results)))
+    return len(chunk.to_csv(index=False).encode()) / max(len(results), 1)
+
+
+def plan_search(full_data, dimension, processes=None, threshold=1,
+                top_k=None, engine='brute', length=None, sample_size=20000,
+                time_budget=2, seed=0):
+    '''
+    Estimates the cost of a search of the full_data DataFrame and returns it
+    as a dict (see plan_summary()). processes defaults to every available
+    CPU. top_k is the number of results the search keeps (None for every
+    hit below threshold, as the n_dim_finder.py pair search does) and
+    length the number of best results that are used, for the threshold
+    recommendation (top_k if not given).
+    '''
+    full_data_np = full_data.values
+    m, n = full_data_np.shape
+    cpus = available_cpus()
+    if processes is None:
+        processes = cpus
+    total = osf.count_combinations(m, n, dimension)
+    if not total:
+        raise ValueError('A {}x{} matrix has no {}x{} submatrices.'.format(
+            m, n, dimension, dimension))
+    ranks = osf.SEARCH_ENGINES[engine][1](m, n, dimension)
+    per_rank = total // max(ranks, 1)
+    rms, rows, cols = sample_RMSs(full_data_np, dimension, sample_size, seed)
+    # Once the list is full the workers only keep results below the top_k-th
+    # RMS, which the bnb engine prunes with, so time them with an estimate
+    # of it (erring high when the sample is too small to tell).
+    cutoff = threshold
+    if top_k is not None:
+        cutoff = min(threshold, float(np.quantile(
+            rms, min(1, max(top_k / total, MIN_SAMPLED_HITS / len(rms))))))
+    rate, seconds = measure_throughput(full_data_np, dimension, cutoff,
+                                       engine, time_budget, seed)
+    hit_rate = float(np.mean(rms < threshold))
+    hits = hit_rate * total
+    kept = hits if top_k is None else min(top_k, hits)
+    # Memory: every process starts from about the size of this one, holds a
+    # block of combinations and its own kept results; the parent also holds
+    # the merged results while they are sorted.
+    item = osf.result_dtype(dimension, osf.index_type(m, n)).itemsize
+    base = current_rss_mb()
+    if engine == 'bnb':
+        block = (1 << 20) * (dimension + 4) * 8 / 2 ** 20
+    else:
+        block = 65536 * (2 * dimension + 4 * dimension * dimension) * 8 / \
+            2 ** 20
+    per_process = base + block + 3 * kept * item / 2 ** 20 / max(processes, 1)
+    parent = base + full_data_np.nbytes / 2 ** 20 + 3 * kept * item / 2 ** 20
+    # Recommendations.
+    single = total / rate if rate else 0.0
+    recommended = 1 if single < 10 else cpus
+    memory = available_memory_mb()
+    if memory is not None:
+        fits = int((0.8 * memory - parent) // per_process)
+        recommended = max(1, min(recommended, fits))
+    recommended = min(recommended, max(ranks, 1))
+    task_size = osf.default_task_size(ranks, recommended, engine)
+    buffer_length = max(1000000, 4 * recommended * task_size * per_rank)
+    length = top_k if length is None else length
+    threshold_recommended = None
+    if length is not None and total:
+        share = THRESHOLD_MARGIN * length / total
+        if share < 1 and share * len(rms) >= MIN_SAMPLED_HITS:
+            quantile = float(np.quantile(rms, share))
+            if quantile < threshold:
+                threshold_recommended = float('{:.3g}'.format(quantile))
+    return {'dimension': dimension, 'shape': (m, n), 'engine': engine,
+            'combinations': total,
+            'combinations_per_second': rate,
+            'timed_seconds': seconds,
+            'sample_size': len(rms),
+            'threshold': threshold,
+            'hit_rate': hit_rate,
+            'hits': hits,
+            'kept': kept,
+            'processes': processes,
+            'seconds': total / (rate * min(processes, cpus)) if rate else 0.0,
+            'memory_mb': parent + processes * per_process,
+            'parent_memory_mb': parent,
+            'process_memory_mb': per_process,
+            'available_memory_mb': memory,
+            'output_bytes': kept * _csv_bytes_per_hit(full_data, rms, rows,
+                                                      cols, dimension),
+            'recommended_processes': recommended,
+            'recommended_seconds': (total / (rate * min(recommended, cpus))
+                                    if rate else 0.0),
+            'recommended_task_size': task_size,
+            'recommended_buffer_length': buffer_length,
+            'recommended_threshold': threshold_recommended,
+            'recommended_threshold_hits': (
+                None if threshold_recommended is None else
+                float(np.mean(rms < threshold_recommended)) * total)}
+
+
+def _size(size_bytes):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size_bytes < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(size_bytes, unit)
+        size_bytes /= 1024
+
+
+def _duration(seconds):
+    return str(timedelta(seconds=round(seconds)))
+
+
+def plan_summary(plan, buffer_length=True, output=True):
+    '''
+    The lines to print for a plan_search() plan. buffer_length=False and
+    output=False leave out the buffer length and the size of the results as
+    a .csv, for scripts that do not take the one or write the other.
+    '''
+    m, n = plan['shape']
+    lines = [
+        'Plan for a {0}x{0} search of a {1}x{2} matrix with the {3} engine:'
+        .format(plan['dimension'], m, n, plan['engine']),
+        '  combinations: {:,}'.format(plan['combinations']),
+        '  throughput: {:,.0f} combinations/s per process (timed for {:.1f}'
+        ' s)'.format(plan['combinations_per_second'], plan['timed_seconds']),
+        '  hits below {}: about {:.2%} ({:,.0f}) in a sample of {:,}; {:,.0f}'
+        ' kept'.format(plan['threshold'], plan['hit_rate'], plan['hits'],
+                       plan['sample_size'], plan['kept']),
+        '  predicted wall time with {} process(es): {}'.format(
+            plan['processes'], _duration(plan['seconds'])),
+        '  predicted peak memory: {:,.0f} MB ({:,.0f} MB in the main process,'
+        ' {:,.0f} MB per worker){}'.format(
+            plan['memory_mb'], plan['parent_memory_mb'],
+            plan['process_memory_mb'],
+            '' if plan['available_memory_mb'] is None else
+            ', {:,.0f} MB available'.format(plan['available_memory_mb'])),
+    ]
+    if output:
+        lines.append('  predicted output size: {} as .csv'.format(
+            _size(plan['output_bytes'])))
+    recommended = '-p {}'.format(plan['recommended_processes'])
+    if buffer_length:
+        recommended += ' -b {}'.format(plan['recommended_buffer_length'])
+    if plan['recommended_threshold'] is not None:
+        recommended += ' -t {}'.format(plan['recommended_threshold'])
+    lines.append('Recommended: {} (about {}{})'.format(
+        recommended, _duration(plan['recommended_seconds']),
+        '' if plan['recommended_threshold'] is None else
+        ', about {:,.0f} hits below the threshold'.format(
+            plan['recommended_threshold_hits'])))
+    return lines
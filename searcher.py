@@ -0,0 +1,108 @@
+'''
+Importable search API for notebooks and pipelines that run many searches on
+the same matrix. Requires the orthogonal_set_finder.py file.
+
+    with Searcher('screen.csv', processes=8) as searcher:
+        for dimension in (2, 3):
+            for threshold in (0.5, 0.2):
+                result = searcher.search(dimension, threshold, top_k=1000)
+        networks = searcher.networks(3)
+'''
+from multiprocessing import Pool
+import pandas as pd
+from orthogonal_set_finder import (APPROXIMATE_ENGINES, attach_shared_data,
+                                   beam_search, clean_raw_data, format_OSF,
+                                   load_data, pool_search, share_data,
+                                   write_OSF)
+import n_dim_finder
+
+
+class Searcher(object):
+    '''
+    Loads and cleans a matrix once and keeps it in shared memory, attached
+    to a pool of processes worker processes that lives until close() (or
+    the end of a with block). Every search() and networks() call then runs
+    on the warm pool, so a sweep over dimensions and thresholds only starts
+    the processes and copies the data once.
+
+    data is the path of an input .csv (loaded with load_data(), using floor
+    and cache) or a DataFrame, which is cleaned in a copy. monitor, a
+    search_monitor.RunMonitor, is passed to every search if given.
+    '''
+
+    def __init__(self, data, processes=1, floor=1000, cache=False,
+                 monitor=None):
+        if isinstance(data, pd.DataFrame):
+            data = data.astype('float64')
+            clean_raw_data(data, floor)
+        else:
+            data = load_data(data, floor=floor, cache=cache, monitor=monitor)
+        self.full_data = data
+        self.processes = processes
+        self.monitor = monitor
+        self._shm, self._data_spec = share_data(data.values)
+        self._pool = Pool(processes=processes,
+                          initializer=attach_shared_data,
+                          initargs=(self._data_spec,))
+        self._pairs = None
+
+    def close(self):
+        '''
+        Stops the worker processes and frees the shared data.
+        '''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._shm.close()
+            self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def search(self, dimension=2, threshold=1, top_k=1000, engine='brute',
+               **options):
+        '''
+        Searches the matrix for dimension x dimension submatrices and returns
+        the best top_k (all if None) below threshold as a sorted result
+        array. engine is one of SEARCH_ENGINES or 'beam'; other options
+        (e.g. task_size, stats, time_budget) are passed on to pool_search()
+        or beam_search().
+        '''
+        if engine in APPROXIMATE_ENGINES:
+            return beam_search(self._pool, self.full_data.values, dimension,
+                               numProcesses=self.processes,
+                               threshold=threshold, top_k=top_k,
+                               data_spec=self._data_spec, **options)
+        return pool_search(self._pool, self.full_data.values, dimension,
+                           numProcesses=self.processes, threshold=threshold,
+                           top_k=top_k, engine=engine, monitor=self.monitor,
+                           data_spec=self._data_spec, **options)
+
+    def networks(self, dimension=3, threshold=1, length=1000):
+        '''
+        Finds and scores the dimension-dimensional networks among the best
+        length pairs below threshold, as n_dim_finder.py does, and returns
+        its table. The pair search is kept, so asking for other dimensions
+        or lengths at the same threshold does not search again.
+        '''
+        if self._pairs is None or self._pairs[0] != threshold:
+            self._pairs = (threshold, self.search(2, threshold, top_k=None))
+        return n_dim_finder.network_table(self._pairs[1], self.full_data,
+                                          dimension, length, self.monitor)
+
+    def table(self, result, length=1000):
+        '''
+        The format_OSF() table of a search() result.
+        '''
+        return format_OSF(result, self.full_data, list_len=length)
+
+    def write(self, result, path, length=1000, file_format=None):
+        '''
+        Writes a search() result to path as run_OSF.py does.
+        '''
+        write_OSF(result, self.full_data, path, list_len=length,
+                  file_format=file_format, monitor=self.monitor)
@@ -0,0 +1,37 @@
+#!/bin/bash
+
+jobname=$1
+cores=$2
+let pcores=$cores-1
+d=$3 # Dimensions
+t=$4 # Threshold
+shards=$5 # Number of array tasks (nodes) to split the search over
+
+jobname_date="$jobname-c$cores-d$d-t$t-$(date +%Y%m%d).$(date +%H%M)"
+
+echo "---Submitted as---"
+echo "Name: $jobname_date"
+echo "Cores: $cores"
+echo "Dimensions: $d"
+echo "Threshold: $t"
+echo "Shards: $shards"
+echo "full call: "
+cat << _EOF_ > temp.sh
+#!/bin/bash
+
+python3 ~/data/CrossCompare/run_OSF.py -i ${jobname}.csv -o ${jobname_date}.csv -d $d -p $pcores -l 10000 -t $t \
+--shard \$SGE_TASK_ID/$shards > ${jobname_date}.shard-\$SGE_TASK_ID.log
+_EOF_
+cat << _EOF_ > temp_merge.sh
+#!/bin/bash
+
+python3 ~/data/CrossCompare/merge_OSF.py -i ${jobname}.csv -o ${jobname_date}.csv \
+${jobname_date}.csv.shard-*-of-$shards.npz > ${jobname_date}.log
+_EOF_
+
+cat temp.sh temp_merge.sh
+qsub -N $jobname_date -t 1-$shards -q bio,pub64,free* -pe openmp $cores-$cores -m bea temp.sh
+qsub -N $jobname_date-merge -hold_jid $jobname_date -q bio,pub64,free* -m bea temp_merge.sh
+sleep 5
+rm temp.sh temp_merge.sh
+echo "---Done---"
@@ -1,17 +1,43 @@
 '''
 Accepts csv number, and fractions as arguments and writes random subsamples out.
+
+With --ensemble the subsamples are searched in memory instead, and one table
+of how often each submatrix was found is written. Requires the
+orthogonal_set_finder.py file.
 '''
 
 import argparse
 import json
 import random
+from multiprocessing import Pool
+from sys import exit
 import pandas as pd
+from orthogonal_set_finder import (ensemble_search, aggregate_results,
+                                   format_ensemble, load_data,
+                                   random_subsets)
+from search_monitor import RunMonitor
 
 def random_df_sample(df, fraction):
     indicies = list(df.index)
     sample = random.sample(indicies, int(fraction * len(indicies)))
     return df.loc[sample]
 
+def run_ensemble(full_data, dimension, fraction, count, numProcesses=1,
+                 threshold=1, top_k=1000, seed=None, monitor=None,
+                 stats=None):
+    '''
+    Searches count random subsamples of fraction of the rows of full_data,
+    drawn with random_subsets(), in one pool. Returns the aggregate_results()
+    of the best top_k hits of every subsample.
+    '''
+    subsets = random_subsets(full_data.shape[0], fraction, count, seed)
+    with Pool(processes=numProcesses) as pool:
+        result_arrays = ensemble_search(pool, full_data.values, dimension,
+                                        subsets, numProcesses=numProcesses,
+                                        threshold=threshold, top_k=top_k,
+                                        monitor=monitor, stats=stats)
+    return aggregate_results(result_arrays)
+
 def main():
     #################################################################
     # setup parser for accepting arguments from the bash shell
@@ -27,12 +53,78 @@ def main():
     parser.add_argument('-n', '--file_number',
                         help='Number of files to output.',
                         default=5, type=int)
+    parser.add_argument('--seed',
+                        help='Random seed, so the same subsamples can be drawn'
+                        ' again. default: none.', default=None, type=int)
+    parser.add_argument('--ensemble',
+                        help='Search every subsample (of the cleaned matrix)'
+                        ' in memory and write one table of how many'
+                        ' subsamples each submatrix was found in, instead of'
+                        ' the subsample files. default: off',
+                        action='store_true')
+    parser.add_argument('-d', '--dimension',
+                        help='Dimension of the ensemble search. Default: 2.',
+                        default=2, type=int)
+    parser.add_argument('-p', '--processes',
+                        help='Number of processes to spawn. Default: 1.',
+                        default=1, type=int)
+    parser.add_argument('-l', '--length',
+                        help='Length of the result list of each subsample.'
+                        ' default: 1000.', default=1000, type=int)
+    parser.add_argument('-t', '--threshold',
+                        help='Number below which RMSs should be kept.'
+                        ' default: 1.', default=1, type=float)
+    parser.add_argument('--floor',
+                        help='Values below this are raised to it before the'
+                        ' search. default: 1E3.', default=1000, type=float)
+    parser.add_argument('--cache',
+                        help='Use the binary cache of the cleaned input.'
+                        ' default: off', action='store_true')
+    parser.add_argument('--progress_interval',
+                        help='Seconds between progress lines. default: 60.',
+                        default=60, type=float)
+    parser.add_argument('--metrics',
+                        help='Also append the progress and stage timings to'
+                        ' this file as JSON lines. default: off', default=None)
     args = vars(parser.parse_args())
     #################################################################
-    df = pd.read_csv(args["input"], index_col=0)
-    sub_dfs = [random_df_sample(df, args["fraction"]) for _ in range(args["file_number"])]
-    for i, sub_df in enumerate(sub_dfs):
-        sub_df.to_csv(args["output"][:-4] + str(i+1) + '.csv')
+    if not args["ensemble"]:
+        random.seed(args["seed"])
+        df = pd.read_csv(args["input"], index_col=0)
+        sub_dfs = [random_df_sample(df, args["fraction"]) for _ in range(args["file_number"])]
+        for i, sub_df in enumerate(sub_dfs):
+            sub_df.to_csv(args["output"][:-4] + str(i+1) + '.csv')
+        return 1
+    print('Searching {} subsamples of {:.0%} of {} for {}x{} matrices with {}'
+          ' process(es).'.format(args["file_number"], args["fraction"],
+                                 args["input"], args["dimension"],
+                                 args["dimension"], args["processes"]))
+    monitor = RunMonitor(interval=args["progress_interval"],
+                         metrics_path=args["metrics"])
+    try:
+        full_data = load_data(args["input"], floor=args["floor"],
+                              cache=args["cache"], monitor=monitor)
+        stats = {}
+        results, counts = run_ensemble(
+            full_data, args["dimension"], args["fraction"],
+            args["file_number"], numProcesses=args["processes"],
+            threshold=args["threshold"], top_k=args["length"],
+            seed=args["seed"], monitor=monitor, stats=stats)
+        if stats["separate"]:
+            print('Scored {:,} combinations; searching the subsamples one by'
+                  ' one would have scored {:,}.'.format(stats["scored"],
+                                                        stats["separate"]))
+        print("I found {} distinct submatrices.".format(len(results)))
+        with monitor.stage('format'):
+            table = format_ensemble(results, counts, full_data,
+                                    args["file_number"],
+                                    list_len=len(results))
+        with monitor.stage('write'):
+            table.to_csv(args["output"], index=False)
+        print('Result saved to {}'.format(args["output"]))
+        monitor.summary()
+    finally:
+        monitor.close()
     return 1
 
 